@@ -1,134 +1,380 @@
 import time
+import atexit
 import logging
-import socket
+import collections
+
+from tempcontrol.graphite import (GraphiteClient, MetricsQueue, MetricsSpool,
+                                  MetricsAggregator, PLAINTEXT)
+from tempcontrol.gpio import OutputManager, RPiBackend
+from tempcontrol.scheduler import monotonic
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger("tempcontrol")
 
-GRAPHITE_ADDRESS = ("127.0.0.1", 2003)
+GRAPHITE_HOST = "127.0.0.1"
+GRAPHITE_PROTOCOL = PLAINTEXT  # or PICKLE, UDP - each on its PORTS port
 GRAPHITE_PATH = "fermentation."
+GRAPHITE_SPOOL_DIR = "/var/spool/tempcontroller/graphite"
+GRAPHITE_WINDOW = 300  # (seconds) temperatures are summarised over
 LOG_TO_GRAPHITE = True
+_graphite_sender = None
+_graphite_metrics = None
+_gpio_outputs = None
 
 
 class Fermenter(object):
     """
     Store + manage the state of a fermenter - doesn't actually 
-    drive fridges or heaters.
+    drive fridges or heaters. The state is worked out once whenever
+    temp, setpoint or hysterisis change, reading it has no effect.
     """
     IDLE = 1
     HEATING = 2
     COOLING = 3
-    def __init__(self, name, setpoint, gpio_pin, hysterisis=0.5):
+    def __init__(self, name, setpoint, gpio_pin, hysterisis=0.5,
+                 probe_resolution=None, cooler_pin=None):
+        self._state = self.IDLE
+        self._temp = None
+        self._setpoint = None
+        self._hysterisis = hysterisis
         self.name = name
         self.setpoint = setpoint
-        self.hysterisis = hysterisis
         self.gpio_pin = gpio_pin
-        self.temp = None
-        self._state = self.IDLE
+        self.probe_resolution = probe_resolution
+        self.cooler_pin = cooler_pin
         logger_name = "tempcontrol.Fermenter.%s" % name
         self.log = logging.getLogger(logger_name)
 
     @property
     def state(self):
-        IDLE, HEATING, COOLING = self.IDLE, self.HEATING, self.COOLING
-        if self.temp is None or self.setpoint is None:
-            self._state = IDLE
-        elif self.temp < (self.setpoint - self.hysterisis):
-            self._state = HEATING
-        elif self.temp < self.setpoint:
-            if self._state == COOLING:
-                self._state = IDLE
-        elif self.temp >= self.setpoint and \
-                self.temp <= (self.setpoint + self.hysterisis):
-            if self._state == HEATING:
-                self._state = IDLE
-        elif self.temp > (self.setpoint + self.hysterisis):
-            self._state = COOLING
-        else:
-            # Shouldn't be possible...
-            raise RuntimeError("%2.2f, %2.2f %d" % (self.temp, 
-                self.setpoint, self._state))
         return self._state
 
+    @property
+    def temp(self):
+        return self._temp
+
+    @temp.setter
+    def temp(self, temp):
+        self._temp = temp
+        self._evaluate()
+
+    @property
+    def setpoint(self):
+        return self._setpoint
+
+    @setpoint.setter
+    def setpoint(self, setpoint):
+        self._setpoint = setpoint
+        self._evaluate()
+
+    @property
+    def hysterisis(self):
+        return self._hysterisis
+
+    @hysterisis.setter
+    def hysterisis(self, hysterisis):
+        self._hysterisis = hysterisis
+        self._evaluate()
+
+    def _evaluate(self):
+        self._state = _next_state(self._temp, self._setpoint,
+                                  self._hysterisis, self._state)
+
     def __repr__(self):
         return "<%s(name:%s, set:%s, gpio:%d)>" % (self.__class__.__name__,
                                                    self.name, self.setpoint,
                                                    self.gpio_pin)
 
 
+Transition = collections.namedtuple("Transition",
+                                    "fermenter old new timestamp")
+
+
+class TransitionEngine(object):
+    """
+    Feed readings to fermenters and tell subscribers about each change
+    of state as a Transition(fermenter, old, new, timestamp), so that
+    work like switching heaters happens when something changes rather
+    than on every reading. Subscribers are called in the order they
+    subscribed, one failing doesn't stop the rest.
+    """
+    def __init__(self):
+        self.subscribers = []
+        self.log = logging.getLogger("tempcontrol.TransitionEngine")
+
+    def subscribe(self, callback):
+        """ :param callback: called with each Transition """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def update(self, fermenter, temp, timestamp=None):
+        """ :return: the Transition made, None if the state didn't change """
+        old = fermenter.state
+        fermenter.temp = temp
+        if fermenter.state == old:
+            return None
+        transition = Transition(fermenter, old, fermenter.state,
+                                time.time() if timestamp is None
+                                else timestamp)
+        for callback in self.subscribers:
+            try:
+                callback(transition)
+            except Exception:
+                self.log.exception("%r failed on %r", callback, transition)
+        return transition
+
+    def __repr__(self):
+        return "<%s(subscribers:%d)>" % (self.__class__.__name__,
+                                         len(self.subscribers))
+
+
+def log_transition(transition):
+    """ TransitionEngine subscriber logging every change """
+    names = {Fermenter.IDLE: "idle", Fermenter.HEATING: "heating",
+             Fermenter.COOLING: "cooling"}
+    temp = transition.fermenter.temp
+    transition.fermenter.log.info("%s -> %s at %s" % (
+        names[transition.old], names[transition.new],
+        "no reading" if temp is None else "%2.2f" % temp))
+
+
+def switch_heater(transition):
+    """ TransitionEngine subscriber driving the fermenter's heater """
+    _gpio_output(transition.fermenter.gpio_pin,
+                 int(transition.new == Fermenter.HEATING))
+
+
+def _next_state(temp, setpoint, hysterisis, state):
+    """
+    The hysteresis rule applied by Fermenter.
+
+    :return: the new state for a fermenter at temp that was in state.
+    """
+    if temp is None or setpoint is None:
+        return Fermenter.IDLE
+    elif temp < (setpoint - hysterisis):
+        return Fermenter.HEATING
+    elif temp < setpoint:
+        if state == Fermenter.COOLING:
+            return Fermenter.IDLE
+    elif temp >= setpoint and temp <= (setpoint + hysterisis):
+        if state == Fermenter.HEATING:
+            return Fermenter.IDLE
+    elif temp > (setpoint + hysterisis):
+        return Fermenter.COOLING
+    else:
+        # Shouldn't be possible...
+        raise RuntimeError("%2.2f, %2.2f %d" % (temp, setpoint, state))
+    return state
+
+
 class Fridge(object):
     """
     Manage the state machine for the fridge + drive io pins
     appropriately. There's a compressor delay that must expire
     before calling turn_on() will actually turn the fridge on,
     this is to protect the compressor from burning out.
+
+    To stop the compressor short cycling it also won't come on until
+    it's been off for min_off_time and min_cycle_time has passed since
+    it last came on, and once on it stays on for min_on_time.
+
+    With a scheduler.Scheduler the fridge switches exactly when these
+    times are up, otherwise only when turn_on()/turn_off() are next
+    called. Times are taken from the scheduler's clock, or monotonic().
     """
     OFF = 1
     WAITING = 2
     ON = 3
     WAIT_TIME = 60  # (seconds) to protect the compressor
+    MIN_ON_TIME = 0
+    MIN_OFF_TIME = 0
+    MIN_CYCLE_TIME = 0  # (seconds) from coming on to coming on again
 
-    def __init__(self, gpio_pin):
+    def __init__(self, gpio_pin, scheduler=None, wait_time=None,
+                 min_on_time=None, min_off_time=None, min_cycle_time=None):
         self.gpio_pin = gpio_pin
+        self.scheduler = scheduler
+        if wait_time is not None:
+            self.WAIT_TIME = wait_time
+        if min_on_time is not None:
+            self.MIN_ON_TIME = min_on_time
+        if min_off_time is not None:
+            self.MIN_OFF_TIME = min_off_time
+        if min_cycle_time is not None:
+            self.MIN_CYCLE_TIME = min_cycle_time
         self._state = self.OFF
         self._wait_start = None
+        self._on_at = None
+        self._off_at = None
+        self._timer = None
         self.log = logging.getLogger("tempcontrol.Fridge")
 
     @property
     def state(self):
         return self._state
 
+    @property
+    def deadline(self):
+        """ When a WAITING fridge can come on, None if not waiting """
+        if self._state != self.WAITING:
+            return None
+        deadline = self._wait_start + self.WAIT_TIME
+        if self._off_at is not None:
+            deadline = max(deadline, self._off_at + self.MIN_OFF_TIME)
+        if self._on_at is not None:
+            deadline = max(deadline, self._on_at + self.MIN_CYCLE_TIME)
+        return deadline
+
     def turn_on(self):
-        if self._state == self.OFF:
+        if self._state == self.ON:
+            # Still wanted, forget any turn_off() waiting on MIN_ON_TIME
+            self._cancel_timer()
+        elif self._state == self.OFF:
             assert self._wait_start is None
-            self._wait_start = time.time()
-            self.log.debug("Waiting %d seconds" % self.WAIT_TIME)
+            self._wait_start = self._now()
             self._state = self.WAITING
-        elif self._state == self.WAITING:
+            self.log.debug("Waiting %d seconds" %
+                           (self.deadline - self._wait_start))
+            if self.scheduler is not None:
+                self._timer = self.scheduler.call_at(self.deadline,
+                                                     self._switch_on)
+        elif self._state == self.WAITING and self.scheduler is None:
             assert self._wait_start is not None
-            if (time.time() - self._wait_start) > self.WAIT_TIME:
-                self.log.debug("Turning on")
-                self._state = self.ON
-                _gpio_output(self.gpio_pin, 1)
+            if self._now() > self.deadline:
+                self._switch_on()
 
-    def turn_off(self):
+    def turn_off(self, force=False):
+        """
+        :param force: ignore MIN_ON_TIME, e.g. if the fridge is being
+            replaced.
+        """
+        if self._state == self.ON and not force:
+            earliest = self._on_at + self.MIN_ON_TIME
+            if self._now() < earliest:
+                if self.scheduler is not None and self._timer is None:
+                    self._timer = self.scheduler.call_at(earliest,
+                                                         self._switch_off)
+                return
+        self._cancel_timer()
         if self._state != self.OFF:
-            self.log.debug("Turning off")
-            self._state = self.OFF
-            _gpio_output(self.gpio_pin, 0)
+            self._switch_off()
+
+    def _switch_on(self):
+        self._timer = None
+        self.log.debug("Turning on")
+        self._state = self.ON
+        self._wait_start = None
+        self._on_at = self._now()
+        _gpio_output(self.gpio_pin, 1)
+
+    def _switch_off(self):
+        self._timer = None
+        self.log.debug("Turning off")
+        if self._state == self.ON:
+            self._off_at = self._now()
+        self._state = self.OFF
+        self._wait_start = None
+        _gpio_output(self.gpio_pin, 0)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self.scheduler.cancel(self._timer)
+            self._timer = None
+
+    def _now(self):
+        if self.scheduler is not None:
+            return self.scheduler.now()
+        return monotonic()
 
     def __repr__(self):
         return "<%s(pin:%d)>" % (self.__class__.__name__, self.gpio_pin)
 
 
-def update_fermenters(fermenters, temp, temp_serial):
+class Topology(object):
+    """
+    Which fermenters share which fridge (by the fridge's gpio pin,
+    Fermenter.cooler_pin), indexed so that a change to one fermenter
+    only re-evaluates its own fridge:
+
+    by_serial: serial -> Fermenter
+    cooler_of: Fermenter -> Fridge
+    members: fridge gpio pin -> {serial: Fermenter}
+
+    Fermenters whose cooler_pin isn't one of the fridges aren't cooled.
+    """
+    def __init__(self, fermenters, fridges):
+        """
+        :param fermenters: dict of serial -> Fermenter
+        :param fridges: dict of gpio pin -> Fridge
+        """
+        self.fridges = fridges
+        self.by_serial = dict(fermenters)
+        self.cooler_of = {}
+        self.members = dict((pin, {}) for pin in fridges)
+        for serial, fermenter in fermenters.items():
+            fridge = fridges.get(fermenter.cooler_pin)
+            if fridge is not None:
+                self.cooler_of[fermenter] = fridge
+                self.members[fridge.gpio_pin][serial] = fermenter
+
+    def update_cooler(self, fermenter):
+        """
+        Turn fermenter's fridge on/off for its members.
+
+        :return: the Fridge, None if fermenter isn't in one.
+        """
+        fridge = self.cooler_of.get(fermenter)
+        if fridge is not None:
+            update_fridge(self.members[fridge.gpio_pin], fridge)
+        return fridge
+
+    def update_coolers(self):
+        """ Turn every fridge on/off for its members """
+        for pin, fridge in self.fridges.items():
+            update_fridge(self.members[pin], fridge)
+
+    def __repr__(self):
+        return "<%s(fermenters:%d, fridges:%d)>" % (
+            self.__class__.__name__, len(self.by_serial), len(self.fridges))
+
+
+def update_fermenters(fermenters, temp, temp_serial, engine=None):
     """
     Take in a DS18B20 temperature reading and update the corresponding
     fermenter - will simply return if the serial is not recognized.
+
+    :param engine: optional TransitionEngine to feed the reading
+        through, so its subscribers hear about any change of state.
     """
     if temp_serial not in fermenters:
         return
     fermenter = fermenters[temp_serial]
-    fermenter.temp = temp
+    now = time.time()
+    if engine is None:
+        fermenter.temp = temp
+    else:
+        engine.update(fermenter, temp, now)
     if LOG_TO_GRAPHITE and fermenter.setpoint is not None:
         path = GRAPHITE_PATH + fermenter.name
-        metrics = ((path + ".temp", fermenter.temp, time.time()),
-                   (path + ".setpoint", fermenter.setpoint, time.time()),
-                   (path + ".heating",
-                    float(fermenter.state is fermenter.HEATING),
-                    time.time()),
-                   (path + ".cooling",
-                    float(fermenter.state is fermenter.COOLING),
-                    time.time()))
-        log_to_graphite(*metrics)
+        state = fermenter.state
+        metrics = graphite_metrics()
+        metrics.gauge(path + ".temp", fermenter.temp, now)
+        metrics.event(path + ".setpoint", fermenter.setpoint, now)
+        metrics.event(path + ".heating", float(state == Fermenter.HEATING),
+                      now)
+        metrics.event(path + ".cooling", float(state == Fermenter.COOLING),
+                      now)
 
 
 def update_fridge(fermenters, fridge):
     """
     Turn fridge on if any of the fermenters need it - only turn
-    the fridge off if none of the fermenters need it.
-    Only supporting one fridge at the moment - assuming both fermenters
-    are sharing it.
+    the fridge off if none of the fermenters need it. The fermenters
+    given are assumed to share the fridge, see Topology for more than
+    one fridge.
     """
     states = [fermenter.state for fermenter in fermenters.values()]
     if Fermenter.COOLING in states:
@@ -150,19 +396,54 @@ def update_heaters(fermenters):
             _gpio_output(gpio_pin, 0)
 
 
+def graphite_sender():
+    """
+    The MetricsQueue shared by everything sending to GRAPHITE_HOST with
+    GRAPHITE_PROTOCOL, started on first use and stopped (with a final
+    flush) at exit.
+    """
+    global _graphite_sender
+    if _graphite_sender is None:
+        spool = MetricsSpool(GRAPHITE_SPOOL_DIR)
+        client = GraphiteClient(GRAPHITE_HOST, spool=spool,
+                                protocol=GRAPHITE_PROTOCOL)
+        _graphite_sender = MetricsQueue(client)
+        _graphite_sender.start()
+        atexit.register(_graphite_sender.stop)
+    return _graphite_sender
+
+
+def graphite_metrics():
+    """
+    The MetricsAggregator in front of graphite_sender(), its partial
+    windows are flushed at exit (before the sender is stopped).
+    """
+    global _graphite_metrics
+    if _graphite_metrics is None:
+        _graphite_metrics = MetricsAggregator(graphite_sender(),
+                                              window=GRAPHITE_WINDOW)
+        # atexit runs last registered first
+        atexit.register(_graphite_metrics.flush)
+    return _graphite_metrics
+
+
 def log_to_graphite(*metrics):
-    log = logging.getLogger("log_to_graphite")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        sock.connect(GRAPHITE_ADDRESS)
-        str_metrics = ["%s %2.2f %d" % metric for metric in metrics]
-        sock.sendall("\n".join(str_metrics) + "\n")
-    except socket.error:
-        log.warning("Could not send metrics to: %s:%d" % GRAPHITE_ADDRESS)
+    """
+    Queue (path, value, timestamp) metrics on graphite_sender(), never
+    blocks or raises on a graphite outage.
+    """
+    graphite_sender().send(*metrics)
+
+
+def gpio_outputs():
+    """ The OutputManager driving the pi's pins """
+    global _gpio_outputs
+    if _gpio_outputs is None:
+        _gpio_outputs = OutputManager(RPiBackend())
+    return _gpio_outputs
 
 
 def _gpio_output(pin, value):
     """ Wrapping Rpi.GPIO to make unit testing easier """
     assert value in [1, 0]
-    import RPi.GPIO as GPIO
-    return GPIO.output(pin, value)
+    return gpio_outputs().output(pin, value)
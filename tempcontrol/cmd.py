@@ -1,13 +1,25 @@
 import argparse
 import logging
 import logging.config
-import time
+import threading
+from functools import partial
 import daemon
 
-from tempcontrol.config import (connect_to_rest_service, load_config, teardown,
-                                read_config_file)
-from tempcontrol.w1_gpio import poll_sensors
-from tempcontrol import update_fermenters, update_fridge, update_heaters
+from tempcontrol.config import (connect_to_rest_service, fetch_config,
+                                reconcile, teardown, read_config_file,
+                                CachingAPI, ConfigRefresher, ChangeFeed,
+                                from_snapshot, SNAPSHOT_FILE)
+from tempcontrol.w1_gpio import Sampler, SAMPLE_INTERVAL
+from tempcontrol.runtime import Runtime
+from tempcontrol.scheduler import Scheduler
+from tempcontrol import (Fermenter, Topology, TransitionEngine,
+                         log_transition, switch_heater, update_fermenters,
+                         update_heaters, graphite_sender, gpio_outputs)
+
+CONTROL_INTERVAL = 1  # (seconds) between looking for new readings
+METRICS_INTERVAL = 30  # (seconds) between graphite flushes
+READING_TIMEOUT = 3 * SAMPLE_INTERVAL  # (seconds) before a silent probe's
+                                       # last reading is dropped
 
 def main():
     """ Main entry point """
@@ -53,40 +65,162 @@ def main():
     log.info("django server url: %s" % url)
     log.info("server (our) name: %s" % our_name)
 
+    api = [None]
     def load_config_():
-        api = connect_to_rest_service(url)
-        return load_config(api, our_name)
+        if api[0] is None:
+            api[0] = CachingAPI(connect_to_rest_service(url))
+        return fetch_config(api[0], our_name)
+    def invalidate(*uris):
+        if api[0] is not None:
+            api[0].invalidate(*uris)
+    changes = ChangeFeed(url, our_name, on_change=invalidate)
     if args.daemon:
         with daemon.DaemonContext():
-            main_loop(load_config_)
+            main_loop(load_config_, changes=changes)
     else:
-        main_loop(load_config_)
+        main_loop(load_config_, changes=changes)
 
 
-def main_loop(load_config):
+def main_loop(load_config, sampler=None, snapshot_file=SNAPSHOT_FILE,
+              changes=None):
     """
-    Run the main loop for this daemon.
+    Run the main loop for this daemon: sampling, control, config refresh
+    and metrics flushing each run as independent tasks, until
+    interrupted.
 
     :param load_config: Callable that returns a fermenters dict and
-        a new fridge object. Will be called regularly to keep our daemon
-        up to date.
+        a fridges dict. Will be called regularly in the background to
+        keep our daemon up to date, the results are reconciled with the
+        running fermenters and fridges.
+    :param sampler: optional w1_gpio.Sampler to take temperature
+        readings from, one will be created and started if not given.
+    :param snapshot_file: where the last good config is kept, so that
+        we can start controlling straight away after a restart.
+    :param changes: optional config.ChangeFeed, config is fetched when
+        it reports a change instead of regularly.
     """
     log = logging.getLogger("tempcontrol.cmd.main_loop")
     log.info("Starting main loop")
-    while True:
-        log.debug("Updating config")
-        fermenters, fridge = load_config()
-
-        def temp_reading_callback(timestamp, serial, temp):
-            update_fermenters(fermenters, temp, serial)
-            update_heaters(fermenters)
-            update_fridge(fermenters, fridge)
-        try:
-            poll_sensors(temp_reading_callback)
-            time.sleep(30)
-        finally:
-            log.info("Tearing down")
-            teardown(fermenters, fridge)
-            log.info("Teardown complete")
+    if sampler is None:
+        sampler = Sampler()
+        sampler.start()
+    refresher = ConfigRefresher(load_config, snapshot_file=snapshot_file,
+                                changes=changes)
+    refresher.start()
+    controller = Controller(refresher, sampler)
+    runtime = Runtime()
+    control = runtime.add("control", controller.tick, CONTROL_INTERVAL)
+    runtime.add("config", partial(_wake_on_update, refresher, control), 0)
+    runtime.add("metrics", graphite_sender().flush, METRICS_INTERVAL)
+    try:
+        log.info("Waiting for config")
+        # Timed waits, an untimed Event.wait() can't be interrupted
+        while not refresher.wait(1):
+            pass
+        controller.scheduler.start()
+        runtime.start()
+        runtime.wait()
+    finally:
+        runtime.stop(timeout=1)
+        controller.scheduler.stop()
+        refresher.stop(timeout=1)
+        controller.teardown()
     log.info("Main loop finished")
 
+
+class Controller(object):
+    """
+    The control logic run by main_loop's tasks: applies new config from
+    a ConfigRefresher and feeds new readings from a Sampler through to
+    the fermenters, heaters and fridges. The tasks run in their own
+    threads, as do the fridges' timers (self.scheduler), so they take
+    turns with self.lock.
+
+    A fermenter whose probe hasn't given a new reading for
+    READING_TIMEOUT seconds has its temperature dropped, so it goes
+    idle and its heater and fridge are switched off rather than left
+    running on an old reading.
+
+    :param clock: for the scheduler and reading timeouts, defaults to
+        scheduler.monotonic.
+    """
+    def __init__(self, refresher, sampler, clock=None):
+        self.refresher = refresher
+        self.sampler = sampler
+        self.fermenters = {}
+        self.fridges = {}
+        self.topology = Topology({}, {})
+        self.snapshot = None
+        self.last_seen = {}
+        self.seen_at = {}
+        self.lock = threading.Lock()
+        self.scheduler = Scheduler(clock=clock, lock=self.lock)
+        self.engine = TransitionEngine()
+        self.engine.subscribe(log_transition)
+        self.engine.subscribe(switch_heater)
+        self.engine.subscribe(self._update_fridge)
+        self.log = logging.getLogger("tempcontrol.cmd.Controller")
+
+    def tick(self):
+        """ Apply any new config, then any new readings """
+        with self.lock:
+            if self.refresher.snapshot is not self.snapshot:
+                self.log.debug("Updating config")
+                self.snapshot = self.refresher.snapshot
+                self.fermenters, self.fridges = reconcile(
+                    self.fermenters, self.fridges,
+                    *from_snapshot(self.snapshot, self.scheduler))
+                self.topology = Topology(self.fermenters, self.fridges)
+                for serial, fermenter in self.fermenters.items():
+                    self.sampler.set_resolution(serial,
+                                                fermenter.probe_resolution)
+                # New setpoints may have changed states without a
+                # transition, bring every output up to date
+                with gpio_outputs().batch():
+                    update_heaters(self.fermenters)
+                    self.topology.update_coolers()
+            if self.snapshot is None:
+                return
+            now = self.scheduler.now()
+            with gpio_outputs().batch():
+                for serial in self.sampler.serials():
+                    timestamp, temp = self.sampler.latest(serial)
+                    if self.last_seen.get(serial) != timestamp:
+                        self.last_seen[serial] = timestamp
+                        self.seen_at[serial] = now
+                        update_fermenters(self.fermenters, temp, serial,
+                                          engine=self.engine)
+                self._expire_readings(now)
+
+    def _expire_readings(self, now):
+        """ Drop the temperature of fermenters whose probe has gone quiet """
+        for serial, fermenter in self.fermenters.items():
+            if fermenter.temp is None:
+                continue
+            seen_at = self.seen_at.get(serial)
+            if seen_at is None or now - seen_at > READING_TIMEOUT:
+                fermenter.log.warning("No reading from %s for %ds, "
+                                      "dropping %2.2f", serial,
+                                      READING_TIMEOUT, fermenter.temp)
+                self.engine.update(fermenter, None)
+
+    def _update_fridge(self, transition):
+        """
+        TransitionEngine subscriber, cooling has started or stopped so
+        re-evaluate the fermenter's fridge (only).
+        """
+        if Fermenter.COOLING in (transition.old, transition.new):
+            self.topology.update_cooler(transition.fermenter)
+
+    def teardown(self):
+        with self.lock:
+            if self.snapshot is not None:
+                self.log.info("Tearing down")
+                teardown(self.fermenters, self.fridges)
+                self.log.info("Teardown complete")
+
+
+def _wake_on_update(refresher, task):
+    """ Wake task up when refresher publishes new config """
+    if refresher.wait_for_update(1):
+        task.wake()
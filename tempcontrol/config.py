@@ -1,22 +1,226 @@
 """
 Poll the django server regularly using the REST API.
 """
+import os
+import json
+import time
+import socket
 import httplib
 import logging
+import threading
+import collections
+from urllib import urlencode
 from urlparse import urljoin
 from functools import partial
 import ConfigParser
 
 import drest
-from tempcontrol import Fermenter, Fridge, _gpio_output
+from tempcontrol.httppool import (PooledRequestHandler, ConnectionPool,
+                                  HTTP_TIMEOUT)
+from tempcontrol import Fermenter, Fridge, _gpio_output, gpio_outputs
+from tempcontrol.w1_gpio import IDLE_RESOLUTION, DEFAULT_RESOLUTION
 
 log = logging.getLogger("tempcontrol.config")
+REFRESH_INTERVAL = 30
+# Below the refresh interval so every poll revalidates (a 304 if
+# unchanged), refreshes in between (on change feed news) use the cache
+CACHE_TTL = REFRESH_INTERVAL // 2
+CACHE_SIZE = 256
+MIN_BACKOFF = 5
+MAX_BACKOFF = 600
+LONG_POLL_TIMEOUT = 55
+SNAPSHOT_FILE = "/var/lib/tempcontroller/config.json"
+
+# Plain data versions of the config, safe to share between threads
+FermenterConfig = collections.namedtuple(
+    "FermenterConfig",
+    "serial name setpoint gpio_pin hysterisis probe_resolution cooler_pin")
+ConfigSnapshot = collections.namedtuple("ConfigSnapshot",
+                                        "fermenters fridge_pins")
+
+
+class ConfigError(Exception):
+    """ The server's response wasn't what we expected """
 
 
 def connect_to_rest_service(url):
     url = urljoin(url, "api/v1")
     log.info("Connecting to %s" % url)
-    return drest.TastyPieAPI(url)
+    return drest.TastyPieAPI(url, request_handler=PooledRequestHandler)
+
+
+class CachingAPI(object):
+    """
+    Wrap a drest TastyPieAPI so that GETs made through its resources
+    (api.<resource>.get()/get_by_uri()) are cached by URL: for ttl
+    seconds a cached response is returned without a request, after
+    that it's revalidated with If-None-Match/If-Modified-Since so an
+    unchanged resource costs a 304. At most maxsize responses are
+    kept, least recently used are dropped first.
+    """
+    def __init__(self, api, ttl=CACHE_TTL, maxsize=CACHE_SIZE):
+        self.api = api
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __getattr__(self, name):
+        return _CachedResource(self, getattr(self.api, name))
+
+    def get(self, path, params=None):
+        """ GET path (relative to the api's base url) via the cache """
+        params = params or {}
+        key = (path, tuple(sorted(params.items())))
+        entry = self._entries.pop(key, None)
+        now = time.time()
+        if entry is not None and now - entry.fetched_at < self.ttl:
+            self.hits += 1
+            self._entries[key] = entry
+            return entry.response
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        response = self.api.make_request("GET", path, params=params,
+                                         headers=headers)
+        if response.status == httplib.NOT_MODIFIED and entry is not None:
+            self.revalidated += 1
+            entry.fetched_at = now
+            self._entries[key] = entry
+            return entry.response
+        self.misses += 1
+        if response.status == httplib.OK:
+            self._entries[key] = _CacheEntry(response, now)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return response
+
+    def invalidate(self, *uris):
+        """
+        Drop cached responses that could contain any of the given
+        resource_uris (their detail, set and list requests), or
+        everything if no uris are given.
+        """
+        if not uris:
+            self._entries.clear()
+            return
+        for uri in uris:
+            name, pk = uri.rstrip("/").split("/")[-2:]
+            for key in list(self._entries):
+                path = key[0].strip("/").split("/")
+                if path[0] != name:
+                    continue
+                if len(path) == 1 or path[1:] == [pk] or \
+                        (path[1] == "set" and pk in path[2].split(";")):
+                    del self._entries[key]
+
+    def __repr__(self):
+        return "<%s(hits:%d, revalidated:%d, misses:%d)>" % (
+            self.__class__.__name__, self.hits, self.revalidated,
+            self.misses)
+
+
+class _CachedResource(object):
+    """ Stands in for a drest resource, routing GETs via a CachingAPI """
+    def __init__(self, cache, resource):
+        self.cache = cache
+        self.resource = resource
+
+    def get(self, resource_id=None, params=None):
+        if resource_id:
+            path = "/%s/%s" % (self.resource.path, resource_id)
+        else:
+            path = "/%s" % self.resource.path
+        return self.cache.get(path, self.resource.filter(params or {}))
+
+    def get_by_uri(self, resource_uri, params=None):
+        return self.get(_pk(resource_uri), params)
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+
+class _CacheEntry(object):
+    def __init__(self, response, fetched_at):
+        self.response = response
+        self.fetched_at = fetched_at
+        headers = response.headers or {}
+        self.etag = headers.get("etag")
+        self.last_modified = headers.get("last-modified")
+
+
+class ChangeFeed(object):
+    """
+    Long-poll the server for config changes instead of polling it on a
+    timer. GET api/v1/tempcontrolservers/changes/?name=<our name>
+    &since=<version>&timeout=<seconds> is held open by the server until
+    something this controller uses changes (or timeout passes), then
+    answered with {"version": <int>, "changed": [<resource_uri>, ...]}.
+    The first request has no since and is answered straight away with
+    the current version.
+
+    on_change is called with the changed uris before wait() returns,
+    e.g. CachingAPI.invalidate so that only they are fetched again.
+    """
+    def __init__(self, url, our_name, on_change=None,
+                 timeout=LONG_POLL_TIMEOUT):
+        self.url = urljoin(url, "api/v1/tempcontrolservers/changes/")
+        self.our_name = our_name
+        self.on_change = on_change
+        self.timeout = timeout
+        self.version = None
+        self.supported = True
+        self.pool = ConnectionPool(maxsize=1, timeout=timeout + HTTP_TIMEOUT)
+        self.log = logging.getLogger("tempcontrol.config.ChangeFeed")
+
+    def wait(self):
+        """
+        Block until the server reports a change or the poll times out.
+
+        :return: list of changed resource uris (empty if nothing changed),
+            None if the server can't tell us - it has no change feed or
+            the request failed - so the caller should poll instead.
+        """
+        if not self.supported:
+            return None
+        params = {"name": self.our_name, "timeout": self.timeout}
+        if self.version is not None:
+            params["since"] = self.version
+        try:
+            status, _, data = self.pool.request(
+                "GET", "%s?%s" % (self.url, urlencode(sorted(params.items()))),
+                headers={"Accept": "application/json"})
+            if status == httplib.NOT_FOUND:
+                self.log.info("Server has no change feed, polling instead")
+                self.supported = False
+                return None
+            if status != httplib.OK:
+                raise ConfigError("HTTP %s" % status)
+            result = json.loads(data)
+            version, changed = result["version"], result["changed"]
+        except (socket.error, httplib.HTTPException, ConfigError,
+                ValueError, KeyError, TypeError) as e:
+            self.log.warning("Change feed failed: %s", e)
+            return None
+        first, self.version = self.version is None, version
+        if first or not changed:
+            return []
+        self.log.info("Config changed: %s", ", ".join(changed))
+        if self.on_change is not None:
+            self.on_change(*changed)
+        return changed
+
+    def close(self):
+        self.pool.close()
+
+    def __repr__(self):
+        return "<%s(%s, version:%s)>" % (self.__class__.__name__,
+                                         self.our_name, self.version)
 
 
 def read_config_file(filename):
@@ -30,62 +234,355 @@ def read_config_file(filename):
 
 def load_config(api, our_name):
     """ Load config from django server using our server name """
+    fermenters, fridges = fetch_config(api, our_name)
+    output_pins = [f.gpio_pin for f in fermenters.values()]
+    _setup_gpio(*(sorted(fridges) + output_pins))
+    return fermenters, fridges
+
+
+def fetch_config(api, our_name):
+    """
+    load_config without setting up any GPIO pins.
+
+    :return: (fermenters dict of serial -> Fermenter, fridges dict of
+        gpio pin -> Fridge), each fermenter's cooler_pin says which
+        fridge it's in.
+    """
     server_config = get_tempcontrolserver(api, our_name)
-    fermenter_configs = [get_fermenter(api, uri)
-                         for uri in server_config["fermenters"]]
-    fermenters = _load_fermenters(api, *fermenter_configs)
-    fridge = _load_cooler(api)
+    fermenter_configs = get_fermenters(api, server_config["fermenters"])
+    fermenters = _load_fermenters(api, *[fermenter_configs[uri] for uri
+                                         in server_config["fermenters"]])
+    unassigned = [f for f in fermenters.values() if f.cooler_pin is None]
+    if unassigned:
+        # Fermenters without a cooler of their own share cooler 1, as
+        # they all did before coolers were per fermenter
+        default_pin = _load_cooler(api).gpio_pin
+        for fermenter in unassigned:
+            fermenter.cooler_pin = default_pin
+    fridges = dict((pin, Fridge(pin)) for pin in
+                   set(f.cooler_pin for f in fermenters.values()))
     for fermenter in fermenters.values():
         log.info("Fermenter: %r" % fermenter)
+    return fermenters, fridges
+
+
+def make_snapshot(fermenters, fridges):
+    """ ConfigSnapshot of a fermenters dict + fridges dict """
+    configs = tuple(FermenterConfig(serial, f.name, f.setpoint, f.gpio_pin,
+                                    f.hysterisis, f.probe_resolution,
+                                    f.cooler_pin)
+                    for serial, f in sorted(fermenters.items()))
+    return ConfigSnapshot(configs, tuple(sorted(fridges)))
 
-    output_pins = [f.gpio_pin for f in fermenters.values()]
-    _setup_gpio(fridge.gpio_pin, *output_pins)
-    return fermenters, fridge
 
+def from_snapshot(snapshot, scheduler=None):
+    """
+    :param scheduler: scheduler.Scheduler for the fridges' timers.
+    :return: new (fermenters dict, fridges dict) built from a snapshot
+    """
+    fermenters = dict((config.serial,
+                       Fermenter(name=config.name, setpoint=config.setpoint,
+                                 gpio_pin=config.gpio_pin,
+                                 hysterisis=config.hysterisis,
+                                 probe_resolution=config.probe_resolution,
+                                 cooler_pin=config.cooler_pin))
+                      for config in snapshot.fermenters)
+    fridges = dict((pin, Fridge(pin, scheduler=scheduler))
+                   for pin in snapshot.fridge_pins)
+    return fermenters, fridges
 
-def teardown(fermenters, fridge):
+
+def save_snapshot(snapshot, filename):
+    """
+    Write snapshot to filename as json, atomically (via a temporary
+    file + rename) so a power cut can't leave a half written file.
+    """
+    data = {"fridge_pins": list(snapshot.fridge_pins),
+            "fermenters": [config._asdict()
+                           for config in snapshot.fermenters]}
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filename, filename)
+
+
+def load_snapshot(filename):
+    """
+    :return: ConfigSnapshot saved by save_snapshot, None if there isn't
+        a (valid) one.
+    """
+    try:
+        with open(filename, 'r') as f:
+            data = json.load(f)
+        if "fridge_pins" not in data:
+            # Saved when there was only the one fridge
+            data["fridge_pins"] = [data["fridge_pin"]]
+            for config in data["fermenters"]:
+                config.setdefault("cooler_pin", data["fridge_pin"])
+        configs = tuple(FermenterConfig(**config)
+                        for config in data["fermenters"])
+        return ConfigSnapshot(configs, tuple(data["fridge_pins"]))
+    except (IOError, OSError):
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        log.warning("Ignoring invalid config snapshot %s: %s" % (filename,
+                                                                 e))
+        return None
+
+
+class ConfigRefresher(object):
+    """
+    Fetch config in a background thread so the control loop never waits
+    on the server. fetch is called every interval seconds and should
+    return (fermenters, fridges); each result that differs from the last
+    is published as a new ConfigSnapshot in self.snapshot, which the
+    control loop can pick up whenever it likes. If fetching fails the
+    last good snapshot stays in place and retries are backed off
+    exponentially from min_backoff up to max_backoff seconds.
+
+    If snapshot_file is given every new snapshot is saved there, and
+    the last one saved is published straight away on startup so we can
+    get going without (or before hearing back from) the server.
+
+    If changes (a ChangeFeed) is given we fetch as soon as it reports a
+    change rather than every interval seconds, polling only while the
+    feed isn't available.
+    """
+    def __init__(self, fetch, interval=REFRESH_INTERVAL,
+                 min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF,
+                 snapshot_file=None, changes=None):
+        self.fetch = fetch
+        self.interval = interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.snapshot_file = snapshot_file
+        self.changes = changes
+        self.snapshot = None
+        self.delay = interval
+        self.failures = 0
+        self._published = threading.Event()
+        self._updated = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.log = logging.getLogger("tempcontrol.config.ConfigRefresher")
+        if snapshot_file is not None:
+            self.snapshot = load_snapshot(snapshot_file)
+            if self.snapshot is not None:
+                self.log.info("Loaded config from %s", snapshot_file)
+                self._published.set()
+
+    def refresh(self):
+        """
+        Fetch and publish config once.
+
+        :return: True if the fetch succeeded.
+        """
+        try:
+            snapshot = make_snapshot(*self.fetch())
+        except Exception:
+            self.failures += 1
+            self.delay = min(self.min_backoff * 2 ** (self.failures - 1),
+                             self.max_backoff)
+            self.log.exception("Config refresh failed, retrying in %d "
+                               "seconds", self.delay)
+            return False
+        self.failures = 0
+        self.delay = self.interval
+        if snapshot != self.snapshot:
+            self.log.info("New config: %r", snapshot)
+            self.snapshot = snapshot
+            self._published.set()
+            self._updated.set()
+            if self.snapshot_file is not None:
+                try:
+                    save_snapshot(snapshot, self.snapshot_file)
+                except (IOError, OSError) as e:
+                    self.log.warning("Could not save config to %s: %s",
+                                     self.snapshot_file, e)
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Wait for the first snapshot to be published.
+
+        :return: True if there is one.
+        """
+        self._published.wait(timeout)
+        return self._published.is_set()
+
+    def wait_for_update(self, timeout=None):
+        """
+        Wait for a snapshot newer than the last time this was called.
+
+        :return: True if there is one.
+        """
+        self._updated.wait(timeout)
+        updated = self._updated.is_set()
+        self._updated.clear()
+        return updated
+
+    def start(self):
+        assert self._thread is None, "already started"
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="config.ConfigRefresher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        :param timeout: give up waiting for the thread after this many
+            seconds, it may be stuck in a long poll.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self.changes is not None and self.changes.version is None:
+                # Take the feed's version before fetching, so that
+                # changes made during the fetch are still reported
+                self.changes.wait()
+            if self.refresh() and self.changes is not None:
+                if self._wait_for_changes() is not None:
+                    continue
+            self._stopped.wait(self.delay)
+
+    def _wait_for_changes(self):
+        """ :return: changed uris, None to fall back to polling """
+        while not self._stopped.is_set():
+            changed = self.changes.wait()
+            if changed is None or changed:
+                return changed
+        return None
+
+    def __repr__(self):
+        return "<%s(interval:%s)>" % (self.__class__.__name__, self.interval)
+
+
+def reconcile(fermenters, fridges, new_fermenters, new_fridges):
+    """
+    Bring the running fermenters and fridges dicts (updated in place)
+    in line with freshly fetched config. The running objects are kept
+    wherever possible so hysteresis state and the compressor delay
+    carry on, and only pins that are added, removed or remapped are
+    touched.
+
+    :param fridges: running dict of gpio pin -> Fridge, None if there
+        aren't any yet.
+    :return: (fermenters, fridges)
+    """
+    if fridges is None:
+        fridges = {}
+    new_pins = []
+    for serial in set(fermenters) - set(new_fermenters):
+        removed = fermenters.pop(serial)
+        log.info("Removing %r" % removed)
+        _gpio_output(removed.gpio_pin, 0)
+    for serial, new in new_fermenters.items():
+        fermenter = fermenters.get(serial)
+        if fermenter is None:
+            log.info("Adding %r" % new)
+            fermenters[serial] = new
+            new_pins.append(new.gpio_pin)
+            continue
+        for attr in ("name", "setpoint", "hysterisis", "probe_resolution",
+                     "cooler_pin"):
+            if getattr(fermenter, attr) != getattr(new, attr):
+                log.info("%r %s: %s -> %s" % (fermenter, attr,
+                                              getattr(fermenter, attr),
+                                              getattr(new, attr)))
+                setattr(fermenter, attr, getattr(new, attr))
+        if fermenter.gpio_pin != new.gpio_pin:
+            log.info("%r moving to pin %d" % (fermenter, new.gpio_pin))
+            _gpio_output(fermenter.gpio_pin, 0)
+            fermenter.gpio_pin = new.gpio_pin
+            new_pins.append(new.gpio_pin)
+    for pin in set(fridges) - set(new_fridges):
+        removed = fridges.pop(pin)
+        log.info("Removing %r" % removed)
+        removed.turn_off(force=True)
+    for pin, new in sorted(new_fridges.items()):
+        if pin not in fridges:
+            log.info("Adding %r" % new)
+            fridges[pin] = new
+            new_pins.append(pin)
+    if new_pins:
+        _setup_gpio(*new_pins)
+    return fermenters, fridges
+
+
+def teardown(fermenters, fridges):
     output_pins = [f.gpio_pin for f in fermenters.values()]
-    output_pins += [fridge.gpio_pin,]
+    output_pins += sorted(fridges)
     map(partial(_gpio_output, value=0), output_pins)
 
 
 def _load_cooler(api):
-    """ Only supporting one fridge atm """
+    """ Cooler 1, shared by fermenters without a cooler of their own """
     response = api.coolers.get(1)
-    assert response.status == httplib.OK
+    _check_response(response, "cooler 1")
     config = response.data
     return Fridge(config["gpio_pin"])
 
 
 def _load_fermenters(api, *configs):
+    """
+    Probes on fermenters without a profile aren't controlling anything,
+    so they're run at IDLE_RESOLUTION to keep bus time down - otherwise
+    the probe's configured resolution is used, DEFAULT_RESOLUTION if it
+    hasn't got one.
+    Heaters, probes, profiles and coolers are fetched with one request
+    per type. Fermenters without a cooler get a cooler_pin of None.
+    """
+    heaters = get_heaters(api, [config["heater"] for config in configs])
+    coolers = get_coolers(api, [config.get("cooler") for config in configs])
+    temp_probes = get_temp_probes(api, [config["probe"]
+                                        for config in configs])
+    profiles = get_fermentation_profiles(api, [config["profile"]
+                                               for config in configs])
     fermenters = {}
     for config in configs:
         profile_uri = config["profile"]
+        heater = heaters[config["heater"]]
+        temp_probe = temp_probes[config["probe"]]
         if profile_uri:
-            profile = get_fermentation_profile(api, profile_uri)
+            profile = profiles[profile_uri]
             setpoint, hysterisis = profile["setpoint"], profile["hysterisis"]
+            resolution = temp_probe.get("resolution") or DEFAULT_RESOLUTION
         else:
             setpoint, hysterisis = None, None
-        heater = get_heater(api, config["heater"])
-        temp_probe = get_temp_probe(api, config["probe"])
+            resolution = IDLE_RESOLUTION
+        cooler_uri = config.get("cooler")
         fermenter = Fermenter(name=config["name"], setpoint=setpoint,
                               gpio_pin=heater["gpio_pin"],
-                              hysterisis=hysterisis)
+                              hysterisis=hysterisis,
+                              probe_resolution=resolution,
+                              cooler_pin=coolers[cooler_uri]["gpio_pin"]
+                              if cooler_uri else None)
         fermenters[temp_probe["serial"]] = fermenter
     return fermenters        
 
 
 def get_tempcontrolserver(api, our_name):
     response = api.tempcontrolservers.get(params=dict(name=our_name))
-    assert response.status == httplib.OK
+    _check_response(response, "server %s" % our_name)
     objects = response.data["objects"]
-    assert len(objects) == 1, "expected 1 server, got %d" % len(objects)
+    if len(objects) != 1:
+        raise ConfigError("expected 1 server, got %d" % len(objects))
     return objects[0]
 
 
 def get_by_uri(api, uri, resource_name):
     response = getattr(api, resource_name).get_by_uri(uri)
-    assert response.status == httplib.OK
+    _check_response(response, uri)
     return response.data
 
 get_fermenter = partial(get_by_uri, resource_name="fermenters")
@@ -96,8 +593,48 @@ get_fermentation_profile = partial(get_by_uri,
                                    resource_name="fermentationprofiles")
 
 
+def get_set(api, uris, resource_name):
+    """
+    Fetch several resources of one type in a single request using
+    TastyPie's set/<id>;<id>/ endpoint. Anything missing from the set
+    response is fetched on its own.
+
+    :return: dict of uri -> resource data (empty uris are skipped).
+    """
+    uris = sorted(set(uri for uri in uris if uri))
+    if not uris:
+        return {}
+    pks = ";".join(_pk(uri) for uri in uris)
+    response = getattr(api, resource_name).get("set/%s" % pks)
+    _check_response(response, "%s set/%s" % (resource_name, pks))
+    by_pk = dict((_pk(obj["resource_uri"]), obj)
+                 for obj in response.data["objects"])
+    resources = {}
+    for uri in uris:
+        resource = by_pk.get(_pk(uri))
+        if resource is None:
+            resource = get_by_uri(api, uri, resource_name)
+        resources[uri] = resource
+    return resources
+
+get_fermenters = partial(get_set, resource_name="fermenters")
+get_heaters = partial(get_set, resource_name="heaters")
+get_coolers = partial(get_set, resource_name="coolers")
+get_temp_probes = partial(get_set, resource_name="tempprobes")
+get_fermentation_profiles = partial(get_set,
+                                    resource_name="fermentationprofiles")
+
+
+def _check_response(response, what):
+    if response.status != httplib.OK:
+        raise ConfigError("Fetching %s failed: HTTP %s" % (what,
+                                                           response.status))
+
+
+def _pk(uri):
+    """ Primary key from a TastyPie resource_uri """
+    return uri.rstrip("/").split("/")[-1]
+
+
 def _setup_gpio(*output_pins):
-    import RPi.GPIO as GPIO
-    GPIO.setmode(GPIO.BCM)
-    for pin_number in output_pins:
-        GPIO.setup(pin_number, GPIO.OUT)
+    gpio_outputs().setup(*output_pins)
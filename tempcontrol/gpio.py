@@ -0,0 +1,99 @@
+"""
+Drive GPIO output pins, only writing to a pin when its value changes.
+"""
+import logging
+from contextlib import contextmanager
+
+
+class RPiBackend(object):
+    """ Real pins, via RPi.GPIO (imported on first use) """
+    def __init__(self):
+        self._gpio = None
+
+    def setup(self, *pins):
+        GPIO = self._import()
+        GPIO.setmode(GPIO.BCM)
+        for pin in pins:
+            GPIO.setup(pin, GPIO.OUT)
+
+    def output(self, pin, value):
+        self._import().output(pin, value)
+
+    def _import(self):
+        if self._gpio is None:
+            import RPi.GPIO as GPIO
+            self._gpio = GPIO
+        return self._gpio
+
+
+class FakeBackend(object):
+    """ In-memory pins for testing/benchmarking off the pi """
+    def __init__(self):
+        self.values = {}
+        self.writes = 0
+
+    def setup(self, *pins):
+        for pin in pins:
+            self.values[pin] = 0
+
+    def output(self, pin, value):
+        self.writes += 1
+        self.values[pin] = value
+
+
+class OutputManager(object):
+    """
+    Remember the last value written to each pin and only pass on
+    writes that change it. Inside batch() writes are held back and only
+    the final value for each pin is written when the batch ends, so a
+    control tick that sets a pin several times costs at most one write.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self._values = {}
+        self._pending = {}
+        self._depth = 0
+        self.log = logging.getLogger("tempcontrol.gpio.OutputManager")
+
+    def setup(self, *pins):
+        """ Configure pins as outputs, forgetting their cached values """
+        self.backend.setup(*pins)
+        for pin in pins:
+            self._values.pop(pin, None)
+            self._pending.pop(pin, None)
+
+    def output(self, pin, value):
+        if self._depth:
+            self._pending[pin] = value
+        else:
+            self._write(pin, value)
+
+    def value(self, pin):
+        """ :return: the last value written to pin, None if unknown """
+        return self._pending.get(pin, self._values.get(pin))
+
+    @contextmanager
+    def batch(self):
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                self.commit()
+
+    def commit(self):
+        """ Write any values held back by batch() """
+        pending, self._pending = self._pending, {}
+        for pin, value in sorted(pending.items()):
+            self._write(pin, value)
+
+    def _write(self, pin, value):
+        if self._values.get(pin) != value:
+            self.log.debug("pin %d -> %d", pin, value)
+            self.backend.output(pin, value)
+            self._values[pin] = value
+
+    def __repr__(self):
+        return "<%s(%s)>" % (self.__class__.__name__,
+                             self.backend.__class__.__name__)
@@ -0,0 +1,453 @@
+"""
+Send metrics to graphite (carbon) over a persistent connection.
+"""
+import os
+import time
+import socket
+import logging
+import struct
+import threading
+import collections
+import cPickle as pickle
+
+FLUSH_INTERVAL = 10
+QUEUE_SIZE = 10000
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+SOCKET_TIMEOUT = 5
+MIN_BACKOFF = 1
+MAX_BACKOFF = 300
+SEGMENT_SIZE = 256 * 1024
+MAX_SEGMENTS = 40
+REPLAY_BATCH = 500
+# Transports, the metrics are always (path, value, timestamp) tuples
+PLAINTEXT = "plaintext"
+PICKLE = "pickle"
+UDP = "udp"
+PORTS = {PLAINTEXT: 2003, PICKLE: 2004, UDP: 2003}
+MAX_DATAGRAM = 1400
+AGGREGATION_WINDOW = 300
+
+
+class GraphiteClient(object):
+    """
+    Batch up (path, value, timestamp) metrics and send them to carbon
+    once per flush, keeping the connection open in between. protocol
+    is PLAINTEXT (one sendall() per flush), PICKLE (carbon's pickle
+    receiver, usually port 2004 - cheaper for big batches) or UDP (fire
+    and forget plaintext datagrams). If the connection fails
+    reconnecting is backed off
+    exponentially (min_backoff doubling up to max_backoff seconds) and
+    the batch is dropped - or written to spool if one is given, to be
+    replayed at up to replay_batch metrics per flush once carbon is
+    back.
+
+    :param address: (host, port), or just the host to use the
+        protocol's usual port from PORTS.
+    """
+    def __init__(self, address, flush_interval=FLUSH_INTERVAL,
+                 min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF,
+                 spool=None, replay_batch=REPLAY_BATCH, protocol=PLAINTEXT):
+        assert protocol in PORTS, protocol
+        if isinstance(address, basestring):
+            address = (address, PORTS[protocol])
+        self.address = tuple(address)
+        self.protocol = protocol
+        self.flush_interval = flush_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.spool = spool
+        self.replay_batch = replay_batch
+        self._batch = []
+        self._sock = None
+        self._last_flush = time.time()
+        self._backoff = 0
+        self._retry_at = None
+        self.log = logging.getLogger("tempcontrol.graphite.GraphiteClient")
+
+    def send(self, *metrics):
+        """ Queue metrics, flushing if flush_interval has passed """
+        self._batch.extend(metrics)
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Send everything queued so far.
+
+        :return: True if the batch was sent (or there was nothing to send).
+        """
+        self._last_flush = time.time()
+        batch, self._batch = self._batch, []
+        if not batch and (self.spool is None or self.spool.empty()):
+            return True
+        if not self._connect() or not self._sendall(self._encode(batch)):
+            self._spool(batch)
+            return False
+        if self.spool is not None:
+            self._replay()
+        return True
+
+    def close(self):
+        self.flush()
+        self._disconnect()
+
+    def _connect(self):
+        if self._sock is not None:
+            return True
+        if self._retry_at is not None and time.time() < self._retry_at:
+            return False
+        sock_type = socket.SOCK_DGRAM if self.protocol == UDP \
+            else socket.SOCK_STREAM
+        sock = socket.socket(socket.AF_INET, sock_type)
+        sock.settimeout(SOCKET_TIMEOUT)
+        try:
+            sock.connect(self.address)
+        except socket.error as e:
+            sock.close()
+            self._back_off()
+            self.log.warning("Could not connect to %s:%d (%s), retrying in "
+                             "%d seconds", self.address[0], self.address[1],
+                             e, self._backoff)
+            return False
+        self.log.info("Connected to %s:%d", *self.address)
+        self._sock = sock
+        self._backoff = 0
+        self._retry_at = None
+        return True
+
+    def _encode(self, metrics):
+        """ :return: list of payloads to send for metrics """
+        if not metrics:
+            return []
+        if self.protocol == PICKLE:
+            return [pickle_metrics(metrics)]
+        elif self.protocol == UDP:
+            return datagrams(metrics)
+        return [format_metrics(metrics)]
+
+    def _sendall(self, payloads):
+        try:
+            for payload in payloads:
+                self._sock.sendall(payload)
+        except socket.error as e:
+            self.log.warning("Could not send metrics to %s:%d: %s",
+                             self.address[0], self.address[1], e)
+            self._disconnect()
+            self._back_off()
+            return False
+        return True
+
+    def _spool(self, batch):
+        if not batch:
+            return
+        if self.spool is None:
+            self.log.warning("Dropping %d metrics", len(batch))
+        else:
+            self.spool.append(format_metrics(batch))
+
+    def _replay(self):
+        data = self.spool.peek(self.replay_batch)
+        if data and self._sendall(self._encode(parse_metrics(data))):
+            self.spool.consume(len(data))
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _back_off(self):
+        self._backoff = min(max(self._backoff * 2, self.min_backoff),
+                            self.max_backoff)
+        self._retry_at = time.time() + self._backoff
+
+    def __repr__(self):
+        return "<%s(%s:%d)>" % ((self.__class__.__name__,) + self.address)
+
+
+class MetricsQueue(object):
+    """
+    Non-blocking front end for a GraphiteClient: send() just puts
+    metrics on a bounded in-memory queue which a background thread
+    drains into the client every flush_interval seconds, so a slow or
+    unreachable carbon server never holds up the caller. When the
+    queue is full either the oldest or the newest metrics are dropped
+    depending on overflow (DROP_OLDEST or DROP_NEWEST).
+    """
+    def __init__(self, client, maxsize=QUEUE_SIZE, overflow=DROP_OLDEST,
+                 flush_interval=FLUSH_INTERVAL):
+        assert overflow in (DROP_OLDEST, DROP_NEWEST), overflow
+        self.client = client
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.log = logging.getLogger("tempcontrol.graphite.MetricsQueue")
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def send(self, *metrics):
+        with self._lock:
+            for metric in metrics:
+                if len(self._queue) >= self.maxsize:
+                    self.dropped += 1
+                    if self.overflow == DROP_NEWEST:
+                        continue
+                    self._queue.popleft()
+                self._queue.append(metric)
+
+    def flush(self):
+        """ Ask the background thread to flush now, doesn't wait for it """
+        self._wakeup.set()
+
+    def start(self):
+        assert self._thread is None, "already started"
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="graphite.MetricsQueue")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread after a final flush """
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def drain(self):
+        """ Hand everything queued to the client and flush it """
+        with self._lock:
+            metrics = list(self._queue)
+            self._queue.clear()
+        if metrics:
+            self.client.send(*metrics)
+        return self.client.flush()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                self.log.exception("Flushing metrics failed")
+        self.drain()
+
+    def __repr__(self):
+        return "<%s(depth:%d, dropped:%d)>" % (self.__class__.__name__,
+                                               self.depth, self.dropped)
+
+
+class MetricsAggregator(object):
+    """
+    Cut down what's sent to sender (a GraphiteClient or MetricsQueue):
+    gauge() values are summarised as path.min, path.max, path.mean and
+    path (the last value) once per window seconds, and event() values
+    (setpoints, on/off states) are only sent when they change - graph
+    them with keepLastValue(). Changes go out straight away with their
+    own timestamp so transitions aren't blurred by the window.
+    """
+    def __init__(self, sender, window=AGGREGATION_WINDOW):
+        self.sender = sender
+        self.window = window
+        self._series = {}
+        self._events = {}
+
+    def gauge(self, path, value, timestamp):
+        series = self._series.get(path)
+        if series is not None and timestamp - series.start >= self.window:
+            self._emit(path, series)
+            series = None
+        if series is None:
+            self._series[path] = _Series(value, timestamp)
+        else:
+            series.add(value, timestamp)
+
+    def event(self, path, value, timestamp):
+        if self._events.get(path) != value:
+            self._events[path] = value
+            self.sender.send((path, value, timestamp))
+
+    def flush(self):
+        """ Send any partial windows and flush the sender """
+        for path, series in self._series.items():
+            self._emit(path, series)
+        self._series.clear()
+        self.sender.flush()
+
+    def _emit(self, path, series):
+        timestamp = series.timestamp
+        self.sender.send((path + ".min", series.min, timestamp),
+                         (path + ".max", series.max, timestamp),
+                         (path + ".mean", series.total / series.count,
+                          timestamp),
+                         (path, series.last, timestamp))
+
+    def __repr__(self):
+        return "<%s(window:%s)>" % (self.__class__.__name__, self.window)
+
+
+class _Series(object):
+    __slots__ = ("start", "timestamp", "count", "total", "min", "max", "last")
+
+    def __init__(self, value, timestamp):
+        self.start = self.timestamp = timestamp
+        self.count = 1
+        self.total = self.min = self.max = self.last = float(value)
+
+    def add(self, value, timestamp):
+        self.timestamp = timestamp
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+
+class MetricsSpool(object):
+    """
+    Append-only on-disk store for formatted metrics that couldn't be
+    sent, kept as a directory of numbered segment files of up to
+    segment_size bytes. Once there are more than max_segments the
+    oldest is deleted. Metrics are read back oldest first with peek()
+    and removed with consume(); the read position isn't persisted so
+    after a restart a partly replayed segment is sent again from the
+    start (carbon just overwrites the duplicate points).
+    """
+    SUFFIX = ".spool"
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE,
+                 max_segments=MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._offset = 0
+        self._lock = threading.Lock()
+        self.log = logging.getLogger("tempcontrol.graphite.MetricsSpool")
+
+    def append(self, data):
+        """ Add formatted metrics (complete lines) to the newest segment """
+        with self._lock:
+            try:
+                segments = self._segments()
+                if not segments or \
+                        os.path.getsize(segments[-1]) >= self.segment_size:
+                    number = self._number(segments[-1]) + 1 if segments \
+                        else 0
+                    segments.append(self._filename(number))
+                with open(segments[-1], 'a') as f:
+                    f.write(data)
+                while len(segments) > self.max_segments:
+                    self.log.warning("Spool full, dropping %s", segments[0])
+                    os.remove(segments.pop(0))
+                    self._offset = 0
+            except (IOError, OSError) as e:
+                self.log.warning("Could not spool metrics: %s", e)
+
+    def peek(self, max_lines):
+        """
+        :return: up to max_lines of the oldest spooled metrics, an empty
+            string if there aren't any.
+        """
+        with self._lock:
+            try:
+                return self._peek(max_lines)
+            except (IOError, OSError) as e:
+                self.log.warning("Could not read spooled metrics: %s", e)
+                return ""
+
+    def consume(self, nbytes):
+        """ Mark nbytes returned from peek() as sent """
+        with self._lock:
+            self._offset += nbytes
+
+    def empty(self):
+        with self._lock:
+            try:
+                segments = self._segments()
+                if len(segments) > 1:
+                    return False
+                return not segments or \
+                    os.path.getsize(segments[0]) <= self._offset
+            except (IOError, OSError):
+                return True
+
+    def _peek(self, max_lines):
+        segments = self._segments()
+        while segments:
+            with open(segments[0], 'r') as f:
+                f.seek(self._offset)
+                lines = []
+                for line in f:
+                    if not line.endswith("\n") or len(lines) == max_lines:
+                        break
+                    lines.append(line)
+            if lines:
+                return "".join(lines)
+            # Fully replayed
+            os.remove(segments.pop(0))
+            self._offset = 0
+        return ""
+
+    def _segments(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory)
+                      if name.endswith(self.SUFFIX))
+
+    def _filename(self, number):
+        return os.path.join(self.directory, "%010d%s" % (number, self.SUFFIX))
+
+    def _number(self, filename):
+        return int(os.path.basename(filename)[:-len(self.SUFFIX)])
+
+    def __repr__(self):
+        return "<%s(%s)>" % (self.__class__.__name__, self.directory)
+
+
+def format_metrics(metrics):
+    """ Format metrics for carbon's plaintext protocol """
+    return "".join(["%s %2.2f %d\n" % metric for metric in metrics])
+
+
+def parse_metrics(data):
+    """ Inverse of format_metrics """
+    metrics = []
+    for line in data.splitlines():
+        path, value, timestamp = line.split()
+        metrics.append((path, float(value), int(timestamp)))
+    return metrics
+
+
+def pickle_metrics(metrics):
+    """ Length-prefixed payload for carbon's pickle protocol """
+    payload = pickle.dumps([(path, (timestamp, value))
+                            for path, value, timestamp in metrics],
+                           protocol=2)
+    return struct.pack("!L", len(payload)) + payload
+
+
+def datagrams(metrics, max_size=MAX_DATAGRAM):
+    """ Plaintext metrics split into datagrams of at most max_size bytes """
+    packets, packet, size = [], [], 0
+    for line in ["%s %2.2f %d\n" % metric for metric in metrics]:
+        if packet and size + len(line) > max_size:
+            packets.append("".join(packet))
+            packet, size = [], 0
+        packet.append(line)
+        size += len(line)
+    if packet:
+        packets.append("".join(packet))
+    return packets
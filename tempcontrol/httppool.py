@@ -0,0 +1,139 @@
+"""
+Keep-alive HTTP connection pooling for the drest REST client.
+"""
+import time
+import base64
+import socket
+import httplib
+import logging
+import threading
+from urlparse import urlsplit
+
+from drest import exc
+from drest.request import TastyPieRequestHandler
+
+POOL_SIZE = 4
+HTTP_TIMEOUT = 10
+
+
+class ConnectionPool(object):
+    """
+    Reuse HTTP/1.1 connections between requests instead of paying for
+    a new TCP connection each time. Up to maxsize idle connections are
+    kept per host, each request has a timeout (seconds). Keeps count of
+    requests, how many reused a connection and the total time spent.
+    """
+    def __init__(self, maxsize=POOL_SIZE, timeout=HTTP_TIMEOUT):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.requests = 0
+        self.reused = 0
+        self.total_latency = 0.0
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.log = logging.getLogger("tempcontrol.httppool.ConnectionPool")
+
+    @property
+    def reuse_ratio(self):
+        return float(self.reused) / self.requests if self.requests else 0.0
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.requests if self.requests else 0.0
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        :return: (status, headers, body) - header names are lower case.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        start = time.time()
+        conn, reused = self._get(key)
+        try:
+            response = self._request(conn, method, path, body, headers)
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # The server probably closed an idle connection, try again
+            conn, reused = self._new(key), False
+            try:
+                response = self._request(conn, method, path, body, headers)
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                raise
+        data = response.read()
+        with self._lock:
+            self.requests += 1
+            self.reused += reused
+            self.total_latency += time.time() - start
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(key, conn)
+        return response.status, dict(response.getheaders()), data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers or {})
+        return conn.getresponse()
+
+    def _get(self, key):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop(), True
+        return self._new(key), False
+
+    def _put(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _new(self, key):
+        scheme, netloc = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def __repr__(self):
+        return "<%s(requests:%d, reuse:%.2f, latency:%.3fs)>" % (
+            self.__class__.__name__, self.requests, self.reuse_ratio,
+            self.mean_latency)
+
+
+class PooledRequestHandler(TastyPieRequestHandler):
+    """
+    drest request handler making its requests through a ConnectionPool
+    (self.pool), use with drest.TastyPieAPI(url,
+    request_handler=PooledRequestHandler).
+    """
+    def __init__(self, **kw):
+        super(PooledRequestHandler, self).__init__(**kw)
+        self.pool = ConnectionPool(timeout=self._meta.timeout or
+                                   HTTP_TIMEOUT)
+
+    def _make_request(self, url, method, payload=None, headers=None):
+        headers = dict(headers or {})
+        if self._auth_credentials:
+            headers["Authorization"] = "Basic " + base64.b64encode(
+                "%s:%s" % self._auth_credentials)
+        try:
+            status, res_headers, data = self.pool.request(
+                method, url, payload or None, headers)
+        except (socket.error, httplib.HTTPException) as e:
+            raise exc.dRestAPIError(str(e))
+        res_headers["status"] = str(status)
+        return res_headers, data
@@ -0,0 +1,118 @@
+"""
+Run the daemon's periodic jobs as independent tasks, each in its own
+thread so that a slow one (REST, graphite, a bad probe) never holds up
+the others.
+"""
+import time
+import logging
+import threading
+
+
+class Task(object):
+    """
+    Call func every interval seconds in a background thread, or sooner
+    if woken with wake(). Exceptions are logged and the task carries on.
+    Keeps count of runs and failures and how long the last run took.
+    """
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.runs = 0
+        self.failures = 0
+        self.last_duration = None
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.log = logging.getLogger("tempcontrol.runtime.Task.%s" % name)
+
+    def start(self):
+        assert self._thread is None, "already started"
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="runtime.%s" % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        :param timeout: give up waiting for a run in progress after this
+            many seconds.
+        """
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        """ Run as soon as possible, doesn't wait for it """
+        self._wakeup.set()
+
+    def run_once(self):
+        """ :return: True if func ran without raising """
+        start = time.time()
+        try:
+            self.func()
+            return True
+        except Exception:
+            self.failures += 1
+            self.log.exception("%s failed", self.name)
+            return False
+        finally:
+            self.runs += 1
+            self.last_duration = time.time() - start
+
+    def _run(self):
+        while not self._stopped:
+            self.run_once()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def __repr__(self):
+        return "<%s(%s, interval:%s)>" % (self.__class__.__name__, self.name,
+                                          self.interval)
+
+
+class Runtime(object):
+    """ A set of Tasks, started and stopped together """
+    def __init__(self):
+        self.tasks = []
+        self._stopped = threading.Event()
+        self.log = logging.getLogger("tempcontrol.runtime.Runtime")
+
+    def add(self, name, func, interval):
+        """ :return: the new Task """
+        task = Task(name, func, interval)
+        self.tasks.append(task)
+        return task
+
+    def start(self):
+        self._stopped.clear()
+        for task in self.tasks:
+            self.log.info("Starting %r", task)
+            task.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        for task in self.tasks:
+            task.stop(timeout)
+
+    def wait(self, timeout=None):
+        """
+        Block until stop() is called (or timeout passes), waking up
+        regularly so that KeyboardInterrupt gets through.
+
+        :return: True if stopped.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._stopped.is_set():
+            remaining = 1 if deadline is None else deadline - time.time()
+            if remaining <= 0:
+                break
+            self._stopped.wait(min(remaining, 1))
+        return self._stopped.is_set()
+
+    def __repr__(self):
+        return "<%s(%s)>" % (self.__class__.__name__,
+                             ", ".join(task.name for task in self.tasks))
@@ -0,0 +1,185 @@
+"""
+Run functions at deadlines measured on a monotonic clock, so timers
+fire on time and aren't thrown out by NTP adjusting the system clock.
+"""
+import os
+import time
+import heapq
+import ctypes
+import ctypes.util
+import logging
+import threading
+import itertools
+
+CLOCK_MONOTONIC = 1  # from <linux/time.h>
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _find_clock_gettime():
+    for name in ("rt", "c"):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        return clock_gettime
+    return None
+
+_clock_gettime = _find_clock_gettime()
+
+
+def monotonic():
+    """
+    Seconds since some arbitrary point, never going backwards or
+    jumping when the system clock is changed. Falls back to time.time()
+    where CLOCK_MONOTONIC isn't available.
+    """
+    if _clock_gettime is None:
+        return time.time()
+    t = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class Timer(object):
+    """ A call scheduled with Scheduler.call_at(), see Scheduler.cancel() """
+    __slots__ = ("deadline", "func", "args", "cancelled")
+
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def __repr__(self):
+        return "<%s(%s at %.3f)>" % (self.__class__.__name__,
+                                     getattr(self.func, "__name__", "?"),
+                                     self.deadline)
+
+
+class Scheduler(object):
+    """
+    Call functions at deadlines on clock (monotonic() by default) from a
+    background thread, which sleeps until the earliest deadline rather
+    than polling. If lock is given each call is made holding it, and
+    calls cancelled while waiting for the lock are skipped - so code
+    holding the lock can rely on cancel().
+
+    run_pending() makes any calls that are due without the thread, for
+    driving a scheduler from a virtual clock.
+    """
+    def __init__(self, clock=None, lock=None):
+        self.clock = clock or monotonic
+        self.lock = lock
+        self._timers = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self.log = logging.getLogger("tempcontrol.scheduler.Scheduler")
+
+    def now(self):
+        return self.clock()
+
+    def call_at(self, deadline, func, *args):
+        """ :return: Timer, for cancel() """
+        timer = Timer(deadline, func, args)
+        with self._cond:
+            heapq.heappush(self._timers,
+                           (deadline, next(self._counter), timer))
+            self._cond.notify()
+        return timer
+
+    def call_later(self, delay, func, *args):
+        return self.call_at(self.now() + delay, func, *args)
+
+    def cancel(self, timer):
+        timer.cancelled = True
+
+    def next_deadline(self):
+        """ :return: the earliest deadline waiting, None if there isn't one """
+        with self._cond:
+            self._discard_cancelled()
+            return self._timers[0][0] if self._timers else None
+
+    def run_pending(self):
+        """
+        Make every call that's due now.
+
+        :return: the number of calls made.
+        """
+        calls = 0
+        for timer in self._pop_due():
+            calls += self._call(timer)
+        return calls
+
+    def start(self):
+        assert self._thread is None, "already started"
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="scheduler.Scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _pop_due(self):
+        due = []
+        with self._cond:
+            now = self.now()
+            while self._timers and self._timers[0][0] <= now:
+                due.append(heapq.heappop(self._timers)[2])
+        return due
+
+    def _discard_cancelled(self):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+
+    def _call(self, timer):
+        if self.lock is not None:
+            with self.lock:
+                return self._call_unlocked(timer)
+        return self._call_unlocked(timer)
+
+    def _call_unlocked(self, timer):
+        if timer.cancelled:
+            return 0
+        try:
+            timer.func(*timer.args)
+        except Exception:
+            self.log.exception("%r failed", timer)
+        return 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    self._discard_cancelled()
+                    if self._timers:
+                        delay = self._timers[0][0] - self.now()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+            self.run_pending()
+
+    def __repr__(self):
+        return "<%s(timers:%d)>" % (self.__class__.__name__,
+                                    len(self._timers))
@@ -0,0 +1,266 @@
+"""
+Simulate fermenters in fridges, so that the control logic can be tried
+out (and hysterisis and compressor timings tuned) many times faster
+than real time, without a pi.
+"""
+import os
+import math
+import time
+import shutil
+import logging
+import tempfile
+import collections
+
+import tempcontrol
+from tempcontrol.cmd import Controller
+from tempcontrol.config import make_snapshot
+from tempcontrol.gpio import FakeBackend, OutputManager
+from tempcontrol.w1_gpio import SensorRegistry, Sampler, SAMPLE_INTERVAL
+
+AMBIENT = 20.0  # (C) room temperature
+W1_SLAVE = ("a4 01 4b 46 7f ff 0c 10 da : crc=da YES\n"
+            "a4 01 4b 46 7f ff 0c 10 da t=%d\n")
+
+Report = collections.namedtuple(
+    "Report", "duration ticks compressor_cycles heater_cycles duty "
+    "overshoot undershoot cpu_per_tick")
+
+
+class VirtualClock(object):
+    """ A clock that only moves when told to, call it for the time """
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def __call__(self):
+        return self.time
+
+    def advance(self, seconds):
+        self.time += seconds
+
+    def __repr__(self):
+        return "<%s(%.1f)>" % (self.__class__.__name__, self.time)
+
+
+class ThermalModel(object):
+    """
+    A fermenter as a single thermal mass. Its temperature relaxes
+    towards its surroundings - the room, or fridge_temp while its fridge
+    is running - at loss (or fridge_loss) per second of the difference,
+    and rises heater_rate degrees per second while its heater is on,
+    plus activity degrees per second from fermentation.
+    """
+    def __init__(self, temp, ambient=AMBIENT, loss=3e-5, heater_rate=8e-3,
+                 fridge_temp=-5.0, fridge_loss=1e-4, activity=0.0):
+        self.temp = temp
+        self.ambient = ambient
+        self.loss = loss
+        self.heater_rate = heater_rate
+        self.fridge_temp = fridge_temp
+        self.fridge_loss = fridge_loss
+        self.activity = activity
+
+    def step(self, seconds, heating=False, cooling=False):
+        """ :return: the temperature after seconds """
+        if cooling:
+            surroundings, loss = self.fridge_temp, self.fridge_loss
+        else:
+            surroundings, loss = self.ambient, self.loss
+        self.temp += (surroundings - self.temp) * \
+            (1 - math.exp(-loss * seconds))
+        self.temp += (self.activity + heating * self.heater_rate) * seconds
+        return self.temp
+
+    def __repr__(self):
+        return "<%s(%.2f)>" % (self.__class__.__name__, self.temp)
+
+
+class Simulation(object):
+    """
+    Run the daemon's control logic (cmd.Controller) against a
+    ThermalModel per fermenter on a VirtualClock. Temperatures are
+    written to a fake w1 sysfs tree and read back through a
+    SensorRegistry + Sampler every tick seconds, outputs land in a
+    gpio.FakeBackend and fridge timers run on the controller's
+    scheduler, stepped to exactly when they're due.
+
+    :param fermenters: dict of serial -> Fermenter, with cooler_pin set
+        for those in a fridge.
+    :param models: dict of serial -> ThermalModel.
+    :param fridge_pins: gpio pins of the fridges.
+    :param fridge_settings: Fridge attributes to override, e.g.
+        {"WAIT_TIME": 120, "MIN_ON_TIME": 300}.
+    :param base_dir: for the fake sysfs tree, a temporary directory
+        (removed by close()) if not given.
+    """
+    def __init__(self, fermenters, models, fridge_pins, tick=SAMPLE_INTERVAL,
+                 fridge_settings=None, base_dir=None):
+        self.models = models
+        self.tick = tick
+        self.fridge_settings = fridge_settings or {}
+        self.clock = VirtualClock()
+        self.backend = _CountingBackend()
+        self.outputs = OutputManager(self.backend)
+        self._own_dir = base_dir is None
+        self._written = {}
+        self.base_dir = base_dir or tempfile.mkdtemp(prefix="w1_")
+        self._write_sensors()
+        master_dir = os.path.join(self.base_dir, "w1_bus_master1")
+        os.mkdir(master_dir)
+        with open(os.path.join(master_dir, "w1_master_slaves"), "w") as f:
+            f.write("".join(serial + "\n" for serial in sorted(models)))
+        self.registry = SensorRegistry(self.base_dir)
+        sampler = Sampler(poll=self._poll, registry=self.registry)
+        config = _StaticConfig(make_snapshot(fermenters,
+                                             dict.fromkeys(fridge_pins)))
+        self.controller = Controller(config, sampler, clock=self.clock)
+        self.ticks = 0
+        self.cpu_time = 0.0
+        self._extremes = {}
+        self.log = logging.getLogger("tempcontrol.simulation.Simulation")
+
+    def run(self, duration):
+        """
+        Simulate duration seconds (on top of any already run).
+
+        :return: Report for everything run so far.
+        """
+        saved = (tempcontrol._gpio_outputs, tempcontrol.LOG_TO_GRAPHITE)
+        tempcontrol._gpio_outputs = self.outputs
+        tempcontrol.LOG_TO_GRAPHITE = False
+        try:
+            if self.controller.snapshot is None:
+                # Config first, so fridge_settings apply from the start
+                self.controller.tick()
+                for fridge in self.controller.fridges.values():
+                    for name, value in self.fridge_settings.items():
+                        setattr(fridge, name, value)
+            end = self.clock() + duration
+            next_tick = self.clock()
+            while self.clock() < end:
+                step_to = min(next_tick, end)
+                deadline = self.controller.scheduler.next_deadline()
+                if deadline is not None:
+                    step_to = min(step_to, max(deadline, self.clock()))
+                self._step(step_to - self.clock())
+                self.controller.scheduler.run_pending()
+                if next_tick <= self.clock() < end:
+                    self._write_sensors()
+                    self._control()
+                    next_tick += self.tick
+        finally:
+            tempcontrol._gpio_outputs, tempcontrol.LOG_TO_GRAPHITE = saved
+        return self.report()
+
+    def report(self):
+        fermenters = self.controller.fermenters
+        fridge_pins = sorted(self.controller.fridges)
+        return Report(
+            duration=self.clock(),
+            ticks=self.ticks,
+            compressor_cycles=dict((pin, self.backend.cycles[pin])
+                                   for pin in fridge_pins),
+            heater_cycles=dict((serial, self.backend.cycles[f.gpio_pin])
+                               for serial, f in fermenters.items()),
+            duty=dict((pin, self.backend.on_time[pin] / self.clock()
+                       if self.clock() else 0.0)
+                      for pin in self.backend.values),
+            overshoot=dict((serial, extremes[1])
+                           for serial, extremes in self._extremes.items()),
+            undershoot=dict((serial, extremes[0])
+                            for serial, extremes in self._extremes.items()),
+            cpu_per_tick=self.cpu_time / self.ticks if self.ticks else 0.0)
+
+    def close(self):
+        self.registry.close()
+        if self._own_dir:
+            shutil.rmtree(self.base_dir)
+
+    def _poll(self, callback):
+        for serial in self.registry.serials():
+            callback(self.clock(), serial,
+                     self.registry.read_temperature(serial))
+
+    def _write_sensors(self):
+        """
+        Write each model's temperature to sysfs, at the DS18B20's 12 bit
+        resolution, if it has changed.
+        """
+        for serial, model in self.models.items():
+            millidegrees = int(round(model.temp * 16) * 62.5)
+            if self._written.get(serial) == millidegrees:
+                continue
+            device_dir = os.path.join(self.base_dir, serial)
+            if serial not in self._written:
+                os.mkdir(device_dir)
+            with open(os.path.join(device_dir, "w1_slave"), "w") as f:
+                f.write(W1_SLAVE % millidegrees)
+            self._written[serial] = millidegrees
+
+    def _control(self):
+        start = time.clock()
+        self.controller.sampler.sample()
+        self.controller.tick()
+        self.controller.scheduler.run_pending()
+        self.cpu_time += time.clock() - start
+        self.ticks += 1
+        self._track_extremes()
+
+    def _step(self, seconds):
+        if seconds <= 0:
+            return
+        values = self.backend.values
+        for serial, model in self.models.items():
+            fermenter = self.controller.fermenters.get(serial)
+            heating = cooling = False
+            if fermenter is not None:
+                heating = bool(values.get(fermenter.gpio_pin))
+                cooling = bool(values.get(fermenter.cooler_pin))
+            model.step(seconds, heating, cooling)
+        self.backend.run(seconds)
+        self.clock.advance(seconds)
+
+    def _track_extremes(self):
+        """
+        How far each fermenter has strayed from its setpoint, once it
+        has first reached it (so the initial pull in isn't counted).
+        """
+        for serial, fermenter in self.controller.fermenters.items():
+            if fermenter.setpoint is None or fermenter.temp is None:
+                continue
+            error = fermenter.temp - fermenter.setpoint
+            extremes = self._extremes.get(serial)
+            if extremes is None:
+                if abs(error) <= fermenter.hysterisis:
+                    self._extremes[serial] = [min(error, 0.0),
+                                              max(error, 0.0)]
+                continue
+            extremes[0] = min(extremes[0], error)
+            extremes[1] = max(extremes[1], error)
+
+    def __repr__(self):
+        return "<%s(%d fermenters, %s)>" % (self.__class__.__name__,
+                                            len(self.models), self.clock)
+
+
+class _StaticConfig(object):
+    """ Stands in for a ConfigRefresher that has a snapshot """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+
+class _CountingBackend(FakeBackend):
+    """ FakeBackend counting each pin's off->on cycles and time on """
+    def __init__(self):
+        super(_CountingBackend, self).__init__()
+        self.cycles = collections.defaultdict(int)
+        self.on_time = collections.defaultdict(float)
+
+    def output(self, pin, value):
+        if value and not self.values.get(pin):
+            self.cycles[pin] += 1
+        super(_CountingBackend, self).output(pin, value)
+
+    def run(self, seconds):
+        for pin, value in self.values.items():
+            if value:
+                self.on_time[pin] += seconds
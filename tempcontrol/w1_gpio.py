@@ -8,32 +8,449 @@ import collections
 import time
 import re
 import logging
+import Queue
+from array import array
+from functools import partial
 
 BASE_DIR = "/sys/bus/w1/devices/"
 TEMPERATURE_READ_BUFFER_SIZE = 200
 TIMEOUT = 20
+MAX_WORKERS = 8
+SAMPLE_INTERVAL = 10
+REFRESH_INTERVAL = 300
+BULK_READ = True
+BULK_POLL_INTERVAL = 0.05
+# DS18B20 resolution (bits) -> conversion time (seconds)
+CONVERSION_TIMES = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
+IDLE_RESOLUTION = 9
+DEFAULT_RESOLUTION = 12  # DS18B20 power-on default
+# parse_driver_outputs status mask values
+CRC_OK = 1
+CRC_FAILED = 0
+CRC_INVALID = -1
+DRIVER_OUTPUT_RE = re.compile(r"(NO|YES)\s.*t=(-?\d+)")
 log = logging.getLogger("tempcontrol.w1_gpio")
+_reader_pools = {}
+_reader_pools_lock = threading.Lock()
 
-def poll_sensors(callback):
+def poll_sensors(callback, max_workers=MAX_WORKERS, timeout=TIMEOUT,
+                 registry=None):
     """
     Look for any DS18B20 temperature sensors and call callback once
     for each sensor found with (timestamp, serial, temperature).
     If there is a CRC failure in the kernel driver, callback will
     not be called.
+
+    Sensors are read concurrently (each read blocks for the sensor's
+    conversion time) by a ReaderPool shared with every other call, and
+    callback is called from the calling thread as each reading
+    completes.
+
+    :param max_workers: maximum number of sensors read at once.
+    :param timeout: (seconds) give up on any sensors still outstanding
+        if no reading has completed for this long, they're skipped by
+        later calls until their reads return.
+    :param registry: optional SensorRegistry to take the device list
+        and open w1_slave files from, otherwise the devices directory
+        is scanned and each w1_slave file opened on every call. If the
+        registry is in bulk mode all sensors are converted at once
+        before being read.
     """
-    # Currently scanning the devices directory and creating new
-    # sensor objects on every loop - not very efficient...
-    # w1_slave seems like it either needs to be opened every time
-    # you want a new reading, or you need to seek(0).
-    dir_names = _look_for_devices(BASE_DIR)
-    sensors = []
-    for serial in dir_names:
-        filename = os.path.join(BASE_DIR, serial, "w1_slave")
-        reading = read_temperature(filename)
+    if registry is not None:
+        jobs = [(serial, serial) for serial in registry.serials()]
+        if registry.bulk and jobs:
+            registry.trigger_bulk_read(timeout)
+        read = registry.read_temperature
+    else:
+        dir_names = _look_for_devices(BASE_DIR)
+        jobs = [(serial, os.path.join(BASE_DIR, serial, "w1_slave"))
+                for serial in dir_names]
+        read = read_temperature
+    for serial, reading in reader_pool(max_workers).read(read, jobs,
+                                                         timeout):
         if reading is not None:
             callback(time.time(), serial, reading)
 
 
+class SensorRegistry(object):
+    """
+    Cache the list of DS18B20 devices along with an open w1_slave file
+    for each of them - w1_slave gives a fresh reading after seek(0) so
+    there's no need to re-open it. The device list is refreshed every
+    refresh_interval seconds, or sooner if a bus master's
+    w1_master_slaves file changes.
+
+    In bulk mode poll_sensors will use the bus masters' therm_bulk_read
+    attribute to convert every sensor at once, rather than waiting for
+    each sensor's conversion in turn.
+    """
+    def __init__(self, base_dir=BASE_DIR, refresh_interval=REFRESH_INTERVAL,
+                 bulk=False):
+        self.base_dir = base_dir
+        self.refresh_interval = refresh_interval
+        self.bulk = bulk
+        self._files = {}
+        self._masters = {}
+        self._bulk_masters = []
+        self._resolutions = {}
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self.log = logging.getLogger("tempcontrol.w1_gpio.SensorRegistry")
+
+    def serials(self):
+        """ :return: list of known serials, refreshed if stale """
+        with self._lock:
+            if self._is_stale():
+                self._refresh()
+            return sorted(self._files.keys())
+
+    def read(self, serial):
+        """ :return: raw w1_slave driver output for serial """
+        with self._lock:
+            f = self._files.get(serial)
+            if f is None:
+                f = self._open(serial)
+        try:
+            f.seek(0)
+            return f.read()
+        except (IOError, OSError):
+            # Device has probably gone - rescan next time round
+            with self._lock:
+                self._forget(serial)
+                self._refreshed_at = None
+            raise
+
+    def read_temperature(self, serial):
+        return _parse_driver_output(self.read(serial))
+
+    def set_resolution(self, serial, bits):
+        """
+        Set serial's resolution (9-12 bits), lower resolutions convert
+        faster. The resolution is re-checked, and re-applied if the
+        sensor has lost it, whenever the device list is refreshed.
+        None goes back to leaving the sensor alone, after putting it
+        back to DEFAULT_RESOLUTION if it had been set.
+        """
+        if bits is not None and bits not in CONVERSION_TIMES:
+            raise ValueError("Invalid resolution: %r" % (bits,))
+        with self._lock:
+            if bits is None:
+                if self._resolutions.pop(serial, None) is not None:
+                    self._apply_resolution(serial, DEFAULT_RESOLUTION)
+            elif self._resolutions.get(serial) != bits:
+                self._resolutions[serial] = bits
+                self._apply_resolution(serial, bits)
+
+    def check_resolutions(self):
+        with self._lock:
+            self._check_resolutions()
+
+    def trigger_bulk_read(self, timeout=TIMEOUT):
+        """
+        Start a simultaneous conversion on every sensor attached to a
+        bus master that supports therm_bulk_read and wait for it to
+        finish. Reading w1_slave afterwards returns the converted value
+        without starting another conversion. Sensors on bus masters
+        without therm_bulk_read (older kernels) are unaffected - they
+        fall back to converting when they're read.
+
+        :return: True if a bulk conversion was done on any bus master.
+        """
+        with self._lock:
+            filenames = list(self._bulk_masters)
+        triggered = []
+        for filename in filenames:
+            try:
+                with open(filename, 'w') as f:
+                    f.write("trigger\n")
+                triggered.append(filename)
+            except (IOError, OSError) as e:
+                self.log.warning("Bulk read trigger failed: %s: %s",
+                                 filename, e)
+        deadline = time.time() + timeout
+        for filename in triggered:
+            while _bulk_read_in_progress(filename):
+                if time.time() > deadline:
+                    self.log.warning("Timed out waiting for bulk read: %s",
+                                     filename)
+                    break
+                time.sleep(BULK_POLL_INTERVAL)
+        return bool(triggered)
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def close(self):
+        with self._lock:
+            for serial in self._files.keys():
+                self._forget(serial)
+            for f, _ in self._masters.values():
+                f.close()
+            self._masters = {}
+            self._refreshed_at = None
+
+    def _is_stale(self):
+        if self._refreshed_at is None or \
+                time.time() - self._refreshed_at > self.refresh_interval:
+            return True
+        for f, contents in self._masters.values():
+            try:
+                f.seek(0)
+                if f.read() != contents:
+                    return True
+            except (IOError, OSError):
+                return True
+        return False
+
+    def _refresh(self):
+        serials = set(_look_for_devices(self.base_dir))
+        for serial in set(self._files) - serials:
+            self._forget(serial)
+        for serial in serials - set(self._files):
+            try:
+                self._open(serial)
+            except (IOError, OSError) as e:
+                self.log.warning("Could not open %s: %s", serial, e)
+        for f, _ in self._masters.values():
+            f.close()
+        self._masters = {}
+        self._bulk_masters = []
+        for name in _look_for_bus_masters(self.base_dir):
+            bulk_filename = os.path.join(self.base_dir, name,
+                                         "therm_bulk_read")
+            if os.path.exists(bulk_filename):
+                self._bulk_masters.append(bulk_filename)
+            filename = os.path.join(self.base_dir, name, "w1_master_slaves")
+            try:
+                f = open(filename, 'r')
+                self._masters[name] = (f, f.read())
+            except (IOError, OSError) as e:
+                self.log.warning("Could not read %s: %s", filename, e)
+        self._check_resolutions()
+        self._refreshed_at = time.time()
+        self.log.debug("Found sensors: %s", ", ".join(sorted(self._files)))
+
+    def _check_resolutions(self):
+        for serial, bits in self._resolutions.items():
+            if serial not in self._files:
+                continue
+            filename = os.path.join(self.base_dir, serial, "resolution")
+            try:
+                with open(filename, 'r') as f:
+                    current = f.read().strip()
+            except (IOError, OSError) as e:
+                self.log.warning("Could not read %s: %s", filename, e)
+                continue
+            if current != str(bits):
+                self.log.info("%s resolution is %s, setting to %d",
+                              serial, current, bits)
+                self._apply_resolution(serial, bits)
+
+    def _apply_resolution(self, serial, bits):
+        filename = os.path.join(self.base_dir, serial, "resolution")
+        try:
+            with open(filename, 'w') as f:
+                f.write("%d\n" % bits)
+        except (IOError, OSError) as e:
+            self.log.warning("Could not set %s resolution: %s", serial, e)
+
+    def _open(self, serial):
+        filename = os.path.join(self.base_dir, serial, "w1_slave")
+        f = self._files[serial] = open(filename, 'r')
+        return f
+
+    def _forget(self, serial):
+        f = self._files.pop(serial, None)
+        if f is not None:
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+
+    def __repr__(self):
+        return "<%s(base_dir:%s)>" % (self.__class__.__name__, self.base_dir)
+
+
+class ReaderPool(object):
+    """
+    max_workers daemon threads reading sensors for poll_sensors, started
+    as they're needed and kept for the life of the process. A sensor
+    whose last read hasn't returned (a hung probe) is skipped rather
+    than given another thread, so it ties up at most one worker however
+    many sweeps it misses.
+    """
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self._jobs = Queue.Queue()
+        self._busy = set()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.log = logging.getLogger("tempcontrol.w1_gpio.ReaderPool")
+
+    def read(self, read, jobs, timeout):
+        """
+        Call read(filename) for each (serial, filename) in jobs, yielding
+        (serial, reading) in the order the reads complete. Sensors that
+        are still outstanding when nothing has completed for timeout
+        seconds are logged and skipped, their reads are left to finish
+        in the background.
+        """
+        results = Queue.Queue()
+        outstanding = set()
+        skipped = []
+        with self._lock:
+            for serial, filename in jobs:
+                if serial in self._busy:
+                    skipped.append(serial)
+                    continue
+                self._busy.add(serial)
+                outstanding.add(serial)
+                self._jobs.put((serial, read, filename, results))
+            self._start_workers()
+        if skipped:
+            self.log.warning("Still waiting on sensors, skipping: %s",
+                             ", ".join(sorted(skipped)))
+        while outstanding:
+            try:
+                serial, reading = results.get(timeout=timeout)
+            except Queue.Empty:
+                self.log.warning("Timed out waiting for sensors: %s",
+                                 ", ".join(sorted(outstanding)))
+                return
+            outstanding.discard(serial)
+            yield serial, reading
+
+    def busy(self):
+        """ :return: serials with a read queued or in progress """
+        with self._lock:
+            return set(self._busy)
+
+    def _start_workers(self):
+        while len(self._threads) < min(self.max_workers, len(self._busy)):
+            thread = threading.Thread(target=self._work,
+                                      name="w1_gpio.worker")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            serial, read, filename, results = self._jobs.get()
+            try:
+                reading = read(filename)
+            except (IOError, OSError) as e:
+                self.log.warning("Could not read %s: %s", serial, e)
+                reading = None
+            except Exception:
+                self.log.exception("Reading %s failed", serial)
+                reading = None
+            with self._lock:
+                self._busy.discard(serial)
+            results.put((serial, reading))
+
+    def __repr__(self):
+        return "<%s(workers:%d/%d)>" % (self.__class__.__name__,
+                                        len(self._threads), self.max_workers)
+
+
+def reader_pool(max_workers=MAX_WORKERS):
+    """ The process wide ReaderPool with max_workers threads """
+    with _reader_pools_lock:
+        pool = _reader_pools.get(max_workers)
+        if pool is None:
+            pool = _reader_pools[max_workers] = ReaderPool(max_workers)
+        return pool
+
+
+class Sampler(object):
+    """
+    Poll the sensors in a background thread, keeping the last
+    buffer_size (timestamp, temperature) readings for each serial
+    so that readings can be queried without blocking on the bus.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL,
+                 buffer_size=TEMPERATURE_READ_BUFFER_SIZE, poll=None,
+                 registry=None):
+        self.interval = interval
+        self.buffer_size = buffer_size
+        if poll is None:
+            if registry is None:
+                registry = SensorRegistry(bulk=BULK_READ)
+            poll = partial(poll_sensors, registry=registry)
+        self.registry = registry
+        self._poll = poll
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.log = logging.getLogger("tempcontrol.w1_gpio.Sampler")
+
+    def start(self):
+        assert self._thread is None, "sampler already started"
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="w1_gpio.Sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def sample(self):
+        """ Poll every sensor once, storing the readings """
+        self._poll(self._store)
+
+    def latest(self, serial):
+        """
+        :return: the most recent (timestamp, temperature) for serial,
+            None if there haven't been any readings.
+        """
+        with self._lock:
+            buf = self._buffers.get(serial)
+            return buf[-1] if buf else None
+
+    def window(self, serial, n):
+        """
+        :return: list of up to the n most recent (timestamp, temperature)
+            readings for serial, oldest first.
+        """
+        with self._lock:
+            buf = self._buffers.get(serial, ())
+            return list(buf)[-n:] if n > 0 else []
+
+    def serials(self):
+        with self._lock:
+            return self._buffers.keys()
+
+    def set_resolution(self, serial, bits):
+        if self.registry is None:
+            self.log.warning("No registry, ignoring %s resolution", serial)
+            return
+        self.registry.set_resolution(serial, bits)
+
+    def _store(self, timestamp, serial, temp):
+        with self._lock:
+            if serial not in self._buffers:
+                self._buffers[serial] = collections.deque(
+                    maxlen=self.buffer_size)
+            self._buffers[serial].append((timestamp, temp))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.sample()
+            except Exception:
+                self.log.exception("Sensor poll failed")
+            self._stopped.wait(self.interval)
+
+    def __repr__(self):
+        return "<%s(interval:%s)>" % (self.__class__.__name__, self.interval)
+
+
 def read_temperature(filename):
     with open(filename, 'r') as f:
         driver_output = f.read()
@@ -50,6 +467,61 @@ def _look_for_devices(base_dir=BASE_DIR):
     return [f for f in os.listdir(base_dir) if f.startswith("28")]
 
 
+def _look_for_bus_masters(base_dir=BASE_DIR):
+    return [f for f in os.listdir(base_dir) if f.startswith("w1_bus_master")]
+
+
+def _bulk_read_in_progress(filename):
+    """
+    therm_bulk_read reads -1 while any sensor is still converting,
+    1 once they've all finished and 0 if there's nothing pending.
+    """
+    with open(filename, 'r') as f:
+        return f.read().strip() == "-1"
+
+
+def parse_driver_outputs(payloads, temps=None, status=None):
+    """
+    Batch version of _parse_driver_output for parsing many w1_slave
+    payloads at once (e.g. replaying logged readings) - nothing is
+    logged per reading.
+
+    :param payloads: sequence of raw w1_slave contents, or one string
+        holding several concatenated payloads (in which case output is
+        only produced for the well-formed ones).
+    :param temps: optional array('d') to reuse for the temperatures.
+    :param status: optional array('b') to reuse for the CRC status.
+    :return: (temps, status) - parallel arrays of temperatures (NaN if
+        unavailable) and CRC_OK, CRC_FAILED or CRC_INVALID for each
+        payload.
+    """
+    if temps is None:
+        temps = array('d')
+    else:
+        del temps[:]
+    if status is None:
+        status = array('b')
+    else:
+        del status[:]
+    nan = float("nan")
+    if isinstance(payloads, basestring):
+        matches = DRIVER_OUTPUT_RE.finditer(payloads)
+    else:
+        search = DRIVER_OUTPUT_RE.search
+        matches = (search(payload) for payload in payloads)
+    for match in matches:
+        if match is None:
+            temps.append(nan)
+            status.append(CRC_INVALID)
+        elif match.group(1) == "NO":
+            temps.append(nan)
+            status.append(CRC_FAILED)
+        else:
+            temps.append(int(match.group(2)) / 1000.0)
+            status.append(CRC_OK)
+    return temps, status
+
+
 def _parse_driver_output(driver_output):
     """
     Driver output in a file named w1_slave is of the form:
@@ -62,13 +534,12 @@ def _parse_driver_output(driver_output):
     :return: Temperature reading if CRC check passed, 
         None otherwise.
     """
-    RE = "(NO|YES)\s.*t=((-|)\d+)"
-    match = re.search(RE, driver_output)
+    match = DRIVER_OUTPUT_RE.search(driver_output)
     if match:
         if match.group(1) == "NO":
             log.warning("One-wire CRC failure")
         else:
-            return float(match.group(2)) / 1000.0
+            return int(match.group(2)) / 1000.0
     else:
-        log.warning("Invalid driver output: %s" % driver_output)
+        log.warning("Invalid driver output: %s", driver_output)
     return None
@@ -1,16 +1,48 @@
 import time
 import os
+import math
+import threading
+import shutil
+import tempfile
 import mock
 import socket
 import httplib
+import json
+import hashlib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import struct
+import cPickle as pickle
 from nose.tools import (assert_equal, assert_false, assert_not_equal,
-                        assert_in)
+                        assert_in, assert_almost_equal)
+
+import tempcontrol
 
 from tempcontrol import (Fridge, update_fridge, Fermenter, update_fermenters,
-                         update_heaters, log_to_graphite)
-from tempcontrol.w1_gpio import poll_sensors
+                         update_heaters, log_to_graphite, gpio_outputs,
+                         graphite_sender, graphite_metrics,
+                         TransitionEngine, Transition,
+                         switch_heater, Topology)
+from tempcontrol.w1_gpio import (poll_sensors, reader_pool, Sampler,
+                                 SensorRegistry, parse_driver_outputs,
+                                 CRC_OK, CRC_FAILED, CRC_INVALID)
+from tempcontrol.graphite import (GraphiteClient, MetricsQueue, MetricsSpool,
+                                  MetricsAggregator,
+                                  DROP_OLDEST, DROP_NEWEST, PICKLE, UDP,
+                                  datagrams)
+from tempcontrol.gpio import OutputManager, FakeBackend
+from tempcontrol.httppool import ConnectionPool, PooledRequestHandler
+from tempcontrol.runtime import Runtime, Task
+from tempcontrol.scheduler import Scheduler, monotonic
+from tempcontrol.simulation import Simulation, ThermalModel
+from tempcontrol.cmd import Controller, main_loop, READING_TIMEOUT
 from tempcontrol.config import (connect_to_rest_service, load_config,
-                                _load_cooler, _load_fermenters)
+                                _load_cooler, _load_fermenters, reconcile,
+                                CachingAPI, get_fermenter, ConfigRefresher,
+                                ConfigError, get_tempcontrolserver,
+                                make_snapshot, from_snapshot, load_snapshot,
+                                fetch_config, ChangeFeed, REFRESH_INTERVAL)
 
 
 def test_Fermenter_state():
@@ -36,6 +68,35 @@ def test_Fermenter_setpoint_None():
     fermenter = Fermenter("uut", setpoint=None, gpio_pin=22)
     fermenter.temp = 5
     assert_equal(fermenter.state, Fermenter.IDLE)
+    fermenter.setpoint = 10
+    assert_equal(fermenter.state, Fermenter.HEATING)
+
+
+def test_TransitionEngine():
+    engine = TransitionEngine()
+    broken = mock.Mock(side_effect=RuntimeError)
+    events = []
+    engine.subscribe(broken)
+    engine.subscribe(events.append)
+    fermenter = Fermenter("uut", 20.0, 22, hysterisis=0.5)
+    for timestamp, temp in enumerate((20.0, 19.0, 19.2, 20.2, 21.0, 20.8)):
+        engine.update(fermenter, temp, timestamp)
+    IDLE, HEATING = Fermenter.IDLE, Fermenter.HEATING
+    COOLING = Fermenter.COOLING
+    assert_equal(events, [Transition(fermenter, IDLE, HEATING, 1),
+                          Transition(fermenter, HEATING, IDLE, 3),
+                          Transition(fermenter, IDLE, COOLING, 4)])
+    assert_equal(broken.call_count, 3)
+    assert_equal(engine.update(fermenter, 20.9), None)
+
+
+@mock.patch("tempcontrol._gpio_output")
+def test_switch_heater(output):
+    fermenter = Fermenter("uut", 20.0, 22)
+    switch_heater(Transition(fermenter, Fermenter.IDLE, Fermenter.HEATING, 0))
+    output.assert_called_with(22, 1)
+    switch_heater(Transition(fermenter, Fermenter.HEATING, Fermenter.IDLE, 0))
+    output.assert_called_with(22, 0)
 
 
 @mock.patch("tempcontrol._gpio_output")
@@ -50,7 +111,7 @@ def test_Fridge_off_waiting_off(output):
 
 
 @mock.patch("tempcontrol._gpio_output")
-@mock.patch("time.time")
+@mock.patch("tempcontrol.monotonic")
 def test_Fridge_off_waiting_on(time_, output):
     time_.return_value = 0
     for i in range(2):
@@ -70,7 +131,7 @@ def test_Fridge_off_waiting_on(time_, output):
 
 
 @mock.patch("tempcontrol._gpio_output")
-@mock.patch("time.time")
+@mock.patch("tempcontrol.monotonic")
 def test_Fridge_on_off(time_, output):
     time_.return_value = 0
     fridge = Fridge(24)
@@ -82,6 +143,7 @@ def test_Fridge_on_off(time_, output):
     output.assert_called_with(24, 0)
 
 
+@mock.patch("tempcontrol.LOG_TO_GRAPHITE", False)
 def test_update_fermenters():
     fermenters = {
         "28-000003ea31f4": Fermenter(name="one", setpoint=14, gpio_pin=22),
@@ -94,6 +156,20 @@ def test_update_fermenters():
         assert_equal(fermenter.temp, temp)
 
 
+@mock.patch("tempcontrol.graphite_metrics")
+def test_update_fermenters_graphite(graphite_metrics):
+    metrics = graphite_metrics.return_value
+    fermenters = {"28-1": Fermenter(name="one", setpoint=14, gpio_pin=22)}
+    update_fermenters(fermenters, 13, "28-1")
+    path = "fermentation.one"
+    timestamp = metrics.gauge.call_args[0][2]
+    metrics.gauge.assert_called_once_with(path + ".temp", 13, timestamp)
+    assert_equal(metrics.event.mock_calls,
+                 [mock.call(path + ".setpoint", 14, timestamp),
+                  mock.call(path + ".heating", 1.0, timestamp),
+                  mock.call(path + ".cooling", 0.0, timestamp)])
+
+
 def test_update_fermenters_3ea1f5b_ignored():
     fermenters = {1: mock.Mock(), 2: mock.Mock()}
     update_fermenters(fermenters, 12, "28-000003ea1f5b")
@@ -154,23 +230,282 @@ def test_update_fridge(output):
             fridge.turn_off.assert_called_with()
 
 
-@mock.patch("socket.socket")
-def test_log_to_graphite(socket_):
-    timestamp = time.time()
-    metric_name = "test.metric.path"
-    value = 23.4
-    log_to_graphite((metric_name, value, timestamp))
-    message = "%s %2.2f %d\n" % (metric_name, value, int(timestamp))
-    socket_().sendall.assert_called_with(message)
+def test_Topology():
+    fermenters = {"28-1": Fermenter("one", 20.0, 22, cooler_pin=24),
+                  "28-2": Fermenter("two", 20.0, 23, cooler_pin=24),
+                  "28-3": Fermenter("three", 20.0, 25, cooler_pin=26),
+                  "28-4": Fermenter("uncooled", 20.0, 27)}
+    fridges = {24: mock.Mock(gpio_pin=24), 26: mock.Mock(gpio_pin=26)}
+    topology = Topology(fermenters, fridges)
+    assert_equal(sorted(topology.members[24]), ["28-1", "28-2"])
+    assert topology.cooler_of[fermenters["28-3"]] is fridges[26]
+    assert_equal(topology.update_cooler(fermenters["28-4"]), None)
+
+    fermenters["28-3"].temp = 25.0
+    assert topology.update_cooler(fermenters["28-3"]) is fridges[26]
+    fridges[26].turn_on.assert_called_once_with()
+    assert_false(fridges[24].method_calls)
+    topology.update_coolers()
+    fridges[24].turn_off.assert_called_once_with()
+
+
+@mock.patch("tempcontrol.graphite_sender")
+def test_log_to_graphite(graphite_sender):
+    metric = ("test.metric.path", 23.4, time.time())
+    log_to_graphite(metric)
+    graphite_sender().send.assert_called_once_with(metric)
+
+
+@mock.patch("atexit.register")
+@mock.patch("tempcontrol.MetricsSpool")
+@mock.patch("tempcontrol.MetricsQueue")
+@mock.patch("tempcontrol._graphite_metrics", None)
+@mock.patch("tempcontrol._graphite_sender", None)
+def test_graphite_metrics_flushed_at_exit(MetricsQueue, MetricsSpool,
+                                          register):
+    sender = MetricsQueue.return_value
+    graphite_metrics().gauge("a.temp", 20.0, 1)
+    for func in reversed([c[0][0] for c in register.call_args_list]):
+        func()
+    assert_equal([name for name, _, _ in sender.mock_calls],
+                 ["start", "send", "flush", "stop"])
+    assert_in(("a.temp", 20.0, 1), sender.send.call_args[0])
+
+
+@mock.patch("atexit.register")
+@mock.patch("tempcontrol.MetricsSpool")
+@mock.patch("tempcontrol.MetricsQueue")
+@mock.patch("tempcontrol._graphite_sender", None)
+def test_graphite_sender_protocol_port(MetricsQueue, MetricsSpool, register):
+    with mock.patch("tempcontrol.GRAPHITE_PROTOCOL", PICKLE):
+        graphite_sender()
+    client = MetricsQueue.call_args[0][0]
+    assert_equal((client.address, client.protocol),
+                 (("127.0.0.1", 2004), PICKLE))
+
+
+def test_OutputManager_only_writes_changes():
+    backend = FakeBackend()
+    outputs = OutputManager(backend)
+    outputs.setup(22, 23)
+    for value in (1, 1, 0, 0, 0):
+        outputs.output(22, value)
+    assert_equal(backend.writes, 2)
+    assert_equal(backend.values, {22: 0, 23: 0})
+    outputs.setup(22)
+    outputs.output(22, 0)
+    assert_equal(backend.writes, 3)
+
+
+def test_OutputManager_batch():
+    backend = FakeBackend()
+    outputs = OutputManager(backend)
+    with outputs.batch():
+        for _ in range(10):
+            outputs.output(22, 1)
+            outputs.output(23, 1)
+            outputs.output(22, 0)
+        assert_equal(backend.writes, 0)
+        assert_equal(outputs.value(22), 0)
+    assert_equal(backend.writes, 2)
+    assert_equal(backend.values, {22: 0, 23: 1})
+
+
+def _graphite_listener():
+    """ Local stand-in for carbon, returns (address, received lines) """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+    received = []
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            received.append("connect")
+            data = conn.recv(65536)
+            while data:
+                received.extend(data.splitlines())
+                data = conn.recv(65536)
+            conn.close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname(), received
+
+
+def test_GraphiteClient_batches_on_one_connection():
+    address, received = _graphite_listener()
+    client = GraphiteClient(address, flush_interval=3600)
+    client.send(("a.temp", 20.0, 1), ("a.setpoint", 18.0, 1))
+    assert_equal(received, [])
+    client.flush()
+    client.send(("a.temp", 20.5, 2))
+    client.close()
+    for _ in range(100):
+        if len(received) == 4:
+            break
+        time.sleep(0.01)
+    assert_equal(received, ["connect", "a.temp 20.00 1",
+                            "a.setpoint 18.00 1", "a.temp 20.50 2"])
 
 
 @mock.patch("socket.socket")
-def test_log_to_graphite_supresses_connection_error(socket_):
+def test_GraphiteClient_backs_off(socket_):
     socket_().connect.side_effect = socket.error
+    socket_.reset_mock()
+    client = GraphiteClient(("127.0.0.1", 2003), min_backoff=10)
+    client.send(("a.temp", 20.0, 1))
+    assert_false(client.flush())
+    client.send(("a.temp", 20.0, 2))
+    assert_false(client.flush())
+    assert_equal(socket_().connect.call_count, 1)
+
+
+def test_GraphiteClient_pickle():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = GraphiteClient(server.getsockname(), protocol=PICKLE)
+    client.send(("a.temp", 20.0, 1), ("a.setpoint", 18.0, 1))
+    assert client.flush()
+    conn, _ = server.accept()
+    length, = struct.unpack("!L", conn.recv(4))
+    payload = ""
+    while len(payload) < length:
+        payload += conn.recv(length - len(payload))
+    client.close()
+    conn.close()
+    server.close()
+    assert_equal(pickle.loads(payload), [("a.temp", (1, 20.0)),
+                                         ("a.setpoint", (1, 18.0))])
+
+
+def test_GraphiteClient_udp():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(1)
+    client = GraphiteClient(server.getsockname(), protocol=UDP)
+    client.send(("a.temp", 20.0, 1), ("a.setpoint", 18.0, 1))
+    assert client.flush()
+    assert_equal(server.recv(65536), "a.temp 20.00 1\na.setpoint 18.00 1\n")
+    client.close()
+    server.close()
+
+
+def test_datagrams_split_on_lines():
+    metrics = [("a.temp", 20.0, i) for i in range(100)]
+    packets = datagrams(metrics, max_size=100)
+    assert all(len(packet) <= 100 for packet in packets)
+    assert all(packet.endswith("\n") for packet in packets)
+    assert_equal("".join(packets).count("\n"), 100)
+
+
+def test_MetricsAggregator_gauge_window():
+    sender = mock.Mock()
+    aggregator = MetricsAggregator(sender, window=60)
+    for timestamp, value in ((0, 20.0), (30, 22.0), (50, 21.0), (60, 19.0)):
+        aggregator.gauge("a.temp", value, timestamp)
+    sender.send.assert_called_once_with(("a.temp.min", 20.0, 50),
+                                        ("a.temp.max", 22.0, 50),
+                                        ("a.temp.mean", 21.0, 50),
+                                        ("a.temp", 21.0, 50))
+    aggregator.flush()
+    assert_equal(sender.send.call_args[0][-1], ("a.temp", 19.0, 60))
+    sender.flush.assert_called_with()
+
+
+def test_MetricsAggregator_events_only_on_change():
+    sender = mock.Mock()
+    aggregator = MetricsAggregator(sender)
+    for timestamp, value in enumerate((0.0, 0.0, 1.0, 1.0, 1.0, 0.0)):
+        aggregator.event("a.heating", value, timestamp)
+    assert_equal(sender.send.call_args_list,
+                 [mock.call(("a.heating", 0.0, 0)),
+                  mock.call(("a.heating", 1.0, 2)),
+                  mock.call(("a.heating", 0.0, 5))])
+
+
+def test_MetricsQueue_overflow():
+    for overflow, expected in ((DROP_OLDEST, [3, 4]), (DROP_NEWEST, [1, 2])):
+        client = mock.Mock()
+        queue = MetricsQueue(client, maxsize=2, overflow=overflow)
+        queue.send(("a", 1, 0), ("a", 2, 0), ("a", 3, 0))
+        queue.send(("a", 4, 0))
+        assert_equal((queue.depth, queue.dropped), (2, 2))
+        queue.drain()
+        sent = [metric[1] for metric in client.send.call_args[0]]
+        assert_equal(sent, expected)
+        assert_equal(queue.depth, 0)
+
+
+def test_MetricsQueue_send_does_not_block():
+    flushing = threading.Event()
+    client = mock.Mock()
+    client.flush.side_effect = lambda: flushing.wait(1)
+    queue = MetricsQueue(client, flush_interval=0.01)
+    queue.start()
+    start = time.time()
+    for i in range(100):
+        queue.send(("a", i, 0))
+        queue.flush()
+    assert time.time() - start < 0.5, "send() blocked on the client"
+    flushing.set()
+    queue.stop()
+    sent = [m[1] for c in client.send.call_args_list for m in c[0]]
+    assert_equal(sent, range(100))
+
+
+def test_MetricsSpool_segments():
+    directory = tempfile.mkdtemp()
+    try:
+        spool = MetricsSpool(directory, segment_size=20, max_segments=2)
+        assert spool.empty()
+        for i in range(3):
+            spool.append("a.temp 20.00 %d\na.temp 21.00 %d\n" % (i, i))
+        # The first segment was dropped to keep within max_segments
+        assert_equal(len(os.listdir(directory)), 2)
+        data = spool.peek(3)
+        assert_equal(data, "a.temp 20.00 1\na.temp 21.00 1\n")
+        spool.consume(len(data))
+        data = spool.peek(1)
+        assert_equal(data, "a.temp 20.00 2\n")
+        spool.consume(len(data))
+        data = spool.peek(10)
+        assert_equal(data, "a.temp 21.00 2\n")
+        spool.consume(len(data))
+        assert spool.empty()
+        assert_equal(spool.peek(10), "")
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_GraphiteClient_spools_and_replays():
+    directory = tempfile.mkdtemp()
     try:
-        log_to_graphite(time.time(), "", 2)
-    except socket.error:
-        assert False, "socket error not supressed"
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        address = server.getsockname()
+        server.close()
+        client = GraphiteClient(address, min_backoff=0,
+                                spool=MetricsSpool(directory),
+                                replay_batch=1)
+        client.send(("a.temp", 20.0, 1), ("a.temp", 21.0, 2))
+        assert_false(client.flush())
+        assert_false(client.spool.empty())
+
+        client.address, received = _graphite_listener()
+        client.send(("a.temp", 22.0, 3))
+        assert client.flush()
+        assert client.flush()
+        client.close()
+        for _ in range(100):
+            if len(received) == 4:
+                break
+            time.sleep(0.01)
+        assert_equal(received, ["connect", "a.temp 22.00 3",
+                                "a.temp 20.00 1", "a.temp 21.00 2"])
+        assert client.spool.empty()
+    finally:
+        shutil.rmtree(directory)
 
 
 @mock.patch("time.time")
@@ -214,10 +549,263 @@ def test_poll_sensors_invalid_driver_output(listdir, open_, time_):
     assert_false(callback.called)
 
 
+@mock.patch("tempcontrol.w1_gpio.read_temperature")
+@mock.patch("os.listdir")
+def test_poll_sensors_reads_concurrently(listdir, read_temperature):
+    listdir.return_value = ["28-1", "28-2", "28-3", "28-4"]
+    def slow_read(filename):
+        time.sleep(0.2)
+        return 20.0
+    read_temperature.side_effect = slow_read
+    callback = mock.Mock()
+    start = time.time()
+    poll_sensors(callback, max_workers=4)
+    assert time.time() - start < 0.6, "sensors were read one at a time"
+    assert_equal(callback.call_count, 4)
+
+
+@mock.patch("tempcontrol.w1_gpio.read_temperature")
+@mock.patch("os.listdir")
+def test_poll_sensors_timeout(listdir, read_temperature):
+    listdir.return_value = ["28-1", "28-2"]
+    hung = threading.Event()
+    def read(filename):
+        if "28-2" in filename:
+            hung.wait(1)
+        return 20.0
+    read_temperature.side_effect = read
+    callback = mock.Mock()
+    poll_sensors(callback, timeout=0.1)
+    hung.set()
+    while reader_pool().busy():
+        time.sleep(0.01)
+    assert_equal([c[0][1] for c in callback.call_args_list], ["28-1"])
+
+
+@mock.patch("tempcontrol.w1_gpio.read_temperature")
+@mock.patch("os.listdir")
+def test_poll_sensors_skips_hung_sensor(listdir, read_temperature):
+    listdir.return_value = ["28-1", "28-2"]
+    hung = threading.Event()
+    reads = []
+    def read(filename):
+        reads.append(filename)
+        if "28-2" in filename:
+            hung.wait(1)
+        return 20.0
+    read_temperature.side_effect = read
+    pool = reader_pool(2)
+    callback = mock.Mock()
+    for _ in range(5):
+        poll_sensors(callback, max_workers=2, timeout=0.05)
+    assert_equal(len([f for f in reads if "28-2" in f]), 1)
+    assert_equal(callback.call_count, 5)
+    assert_equal(len(pool._threads), 2)
+    hung.set()
+    while pool.busy():
+        time.sleep(0.01)
+    callback.reset_mock()
+    poll_sensors(callback, max_workers=2, timeout=0.05)
+    assert_equal(sorted(c[0][1] for c in callback.call_args_list),
+                 ["28-1", "28-2"])
+    assert_equal(len(pool._threads), 2)
+
+
+def test_Sampler_ring_buffer():
+    readings = iter(range(10))
+    def poll(callback):
+        reading = next(readings)
+        callback(reading, "28-1", float(reading))
+    sampler = Sampler(buffer_size=3, poll=poll)
+    assert_equal(sampler.latest("28-1"), None)
+    for _ in range(5):
+        sampler.sample()
+    assert_equal(sampler.latest("28-1"), (4, 4.0))
+    assert_equal(sampler.window("28-1", 2), [(3, 3.0), (4, 4.0)])
+    assert_equal(sampler.window("28-1", 10), [(2, 2.0), (3, 3.0), (4, 4.0)])
+    assert_equal(sampler.window("28-2", 10), [])
+
+
+def test_Sampler_background_thread():
+    polled = threading.Event()
+    def poll(callback):
+        callback(1, "28-1", 20.0)
+        polled.set()
+    sampler = Sampler(interval=0.01, poll=poll)
+    sampler.start()
+    try:
+        assert polled.wait(1)
+    finally:
+        sampler.stop()
+    assert_equal(sampler.latest("28-1"), (1, 20.0))
+
+
+W1_SLAVE = """a4 01 4b 46 7f ff 0c 10 da : crc=da YES
+a4 01 4b 46 7f ff 0c 10 da t=%d
+"""
+
+
+def _write_w1_slave(base_dir, serial, millidegrees):
+    device_dir = os.path.join(base_dir, serial)
+    if not os.path.isdir(device_dir):
+        os.mkdir(device_dir)
+    with open(os.path.join(device_dir, "w1_slave"), "w") as f:
+        f.write(W1_SLAVE % millidegrees)
+
+
+def _write_master_slaves(base_dir, *serials):
+    master_dir = os.path.join(base_dir, "w1_bus_master1")
+    if not os.path.isdir(master_dir):
+        os.mkdir(master_dir)
+    with open(os.path.join(master_dir, "w1_master_slaves"), "w") as f:
+        f.write("".join(serial + "\n" for serial in serials))
+
+
+def test_SensorRegistry_reuses_open_files():
+    base_dir = tempfile.mkdtemp()
+    try:
+        _write_w1_slave(base_dir, "28-1", 20000)
+        _write_master_slaves(base_dir, "28-1")
+        registry = SensorRegistry(base_dir)
+        assert_equal(registry.serials(), ["28-1"])
+        assert_equal(registry.read_temperature("28-1"), 20.0)
+        _write_w1_slave(base_dir, "28-1", 21500)
+        with mock.patch("os.listdir") as listdir, \
+                mock.patch("__builtin__.open") as open_:
+            assert_equal(registry.serials(), ["28-1"])
+            assert_false(listdir.called)
+            assert_false(open_.called)
+        assert_equal(registry.read_temperature("28-1"), 21.5)
+        registry.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def test_SensorRegistry_refreshes_when_master_slaves_changes():
+    base_dir = tempfile.mkdtemp()
+    try:
+        _write_w1_slave(base_dir, "28-1", 20000)
+        _write_master_slaves(base_dir, "28-1")
+        registry = SensorRegistry(base_dir)
+        assert_equal(registry.serials(), ["28-1"])
+        _write_w1_slave(base_dir, "28-2", 18000)
+        _write_master_slaves(base_dir, "28-1", "28-2")
+        assert_equal(registry.serials(), ["28-1", "28-2"])
+        callback = mock.Mock()
+        poll_sensors(callback, registry=registry)
+        assert_equal(sorted(c[0][1:] for c in callback.call_args_list),
+                     [("28-1", 20.0), ("28-2", 18.0)])
+        registry.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def test_poll_sensors_bulk_read():
+    base_dir = tempfile.mkdtemp()
+    try:
+        _write_w1_slave(base_dir, "28-1", 20000)
+        _write_master_slaves(base_dir, "28-1")
+        bulk_read = os.path.join(base_dir, "w1_bus_master1",
+                                 "therm_bulk_read")
+        with open(bulk_read, "w") as f:
+            f.write("0\n")
+        registry = SensorRegistry(base_dir, bulk=True)
+        callback = mock.Mock()
+        poll_sensors(callback, registry=registry)
+        with open(bulk_read) as f:
+            assert_equal(f.read(), "trigger\n")
+        assert_equal(callback.call_args[0][1:], ("28-1", 20.0))
+        registry.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+@mock.patch("time.sleep")
+def test_SensorRegistry_bulk_read_waits_for_conversion(sleep):
+    registry = SensorRegistry(bulk=True)
+    registry._bulk_masters = ["/sys/bus/w1/devices/w1_bus_master1/"
+                              "therm_bulk_read"]
+    with mock.patch("__builtin__.open") as open_:
+        open_().__enter__().read.side_effect = ["-1\n", "-1\n", "1\n"]
+        assert registry.trigger_bulk_read()
+        open_().__enter__().write.assert_called_with("trigger\n")
+    assert_equal(sleep.call_count, 2)
+
+
+def test_SensorRegistry_bulk_read_unsupported():
+    base_dir = tempfile.mkdtemp()
+    try:
+        _write_w1_slave(base_dir, "28-1", 20000)
+        _write_master_slaves(base_dir, "28-1")
+        registry = SensorRegistry(base_dir, bulk=True)
+        callback = mock.Mock()
+        poll_sensors(callback, registry=registry)
+        assert_false(registry.trigger_bulk_read())
+        assert_equal(callback.call_args[0][1:], ("28-1", 20.0))
+        registry.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def test_SensorRegistry_resolution():
+    base_dir = tempfile.mkdtemp()
+    try:
+        _write_w1_slave(base_dir, "28-1", 20000)
+        resolution = os.path.join(base_dir, "28-1", "resolution")
+        with open(resolution, "w") as f:
+            f.write("12\n")
+        registry = SensorRegistry(base_dir)
+        registry.serials()
+        registry.set_resolution("28-1", 9)
+        with open(resolution) as f:
+            assert_equal(f.read(), "9\n")
+        # e.g. sensor power cycled:
+        with open(resolution, "w") as f:
+            f.write("12\n")
+        registry.refresh()
+        with open(resolution) as f:
+            assert_equal(f.read(), "9\n")
+        registry.set_resolution("28-1", None)
+        with open(resolution) as f:
+            assert_equal(f.read(), "12\n")
+        registry.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def test_SensorRegistry_invalid_resolution():
+    registry = SensorRegistry()
+    try:
+        registry.set_resolution("28-1", 8)
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+
+
+def test_parse_driver_outputs():
+    payloads = [W1_SLAVE % 26250, W1_SLAVE.replace("YES", "NO") % 1,
+                "invalid driver output", W1_SLAVE % -1500]
+    temps, status = parse_driver_outputs(payloads)
+    assert_equal(list(status), [CRC_OK, CRC_FAILED, CRC_INVALID, CRC_OK])
+    assert_equal((temps[0], temps[3]), (26.25, -1.5))
+    assert temps[1] != temps[1] and temps[2] != temps[2], "expected NaN"
+
+
+def test_parse_driver_outputs_reuses_buffers():
+    temps, status = parse_driver_outputs([W1_SLAVE % 1000] * 3)
+    result = parse_driver_outputs("".join([W1_SLAVE % 2000] * 2),
+                                  temps, status)
+    assert result[0] is temps and result[1] is status
+    assert_equal(list(temps), [2.0, 2.0])
+    assert_equal(list(status), [CRC_OK, CRC_OK])
+
+
 @mock.patch("drest.TastyPieAPI")
 def test_connect_to_rest_service(TastyPieAPI):
     api = connect_to_rest_service("http://1.2.3.4:8080")
-    TastyPieAPI.assert_called_with("http://1.2.3.4:8080")
+    TastyPieAPI.assert_called_with("http://1.2.3.4:8080/api/v1",
+                                   request_handler=PooledRequestHandler)
     assert_equal(api, TastyPieAPI())
 
 
@@ -245,11 +833,22 @@ def test__load_cooler():
     assert_equal(fridge.gpio_pin, 15)
 
 
-@mock.patch("tempcontrol.config.get_temp_probe")
-@mock.patch("tempcontrol.config.get_fermentation_profile")
-@mock.patch("tempcontrol.config.get_heater")
-def test__load_fermenters(get_heater, get_fermentation_profile,
-                          get_temp_probe):
+def _get_set(**fields):
+    """ side_effect for config.get_set returning fields for every uri """
+    def get_set(api, uris):
+        return dict((uri, dict(fields, uri=uri)) for uri in uris if uri)
+    return get_set
+
+
+@mock.patch("tempcontrol.config.get_temp_probes")
+@mock.patch("tempcontrol.config.get_fermentation_profiles")
+@mock.patch("tempcontrol.config.get_heaters")
+def test__load_fermenters(get_heaters, get_fermentation_profiles,
+                          get_temp_probes):
+    get_heaters.side_effect = _get_set(gpio_pin=22)
+    get_fermentation_profiles.side_effect = _get_set(setpoint=18.0,
+                                                     hysterisis=0.3)
+    get_temp_probes.side_effect = _get_set(serial="28-1")
     api = mock.Mock()
     configs = [{
         "profile": "http://profile",
@@ -258,20 +857,78 @@ def test__load_fermenters(get_heater, get_fermentation_profile,
         "name": "Fermenter1",
     }]
     fermenters = _load_fermenters(api, *configs)
-    get_heater.assert_called_with(api, "http://heater1")
-    get_fermentation_profile.assert_called_with(api, "http://profile")
-    get_temp_probe.assert_called_with(api, "http://probe1")
+    get_heaters.assert_called_once_with(api, ["http://heater1"])
+    get_fermentation_profiles.assert_called_once_with(api,
+                                                      ["http://profile"])
+    get_temp_probes.assert_called_once_with(api, ["http://probe1"])
     assert len(fermenters) == 1
-    assert_equal(fermenters.keys(), [get_temp_probe()["serial"]])
-    fermenter = fermenters[get_temp_probe()["serial"]]
+    assert_equal(fermenters.keys(), ["28-1"])
+    fermenter = fermenters["28-1"]
     assert_equal(fermenter.name, "Fermenter1")
+    assert_equal((fermenter.setpoint, fermenter.gpio_pin), (18.0, 22))
+
+
+@mock.patch("tempcontrol.config.get_temp_probes")
+@mock.patch("tempcontrol.config.get_fermentation_profiles")
+@mock.patch("tempcontrol.config.get_heaters")
+def test__load_fermenters_probe_resolution(get_heaters,
+                                           get_fermentation_profiles,
+                                           get_temp_probes):
+    get_heaters.side_effect = _get_set(gpio_pin=22)
+    get_fermentation_profiles.side_effect = _get_set(setpoint=18.0,
+                                                     hysterisis=0.3)
+    api = mock.Mock()
+    get_temp_probes.return_value = {
+        "http://probe1": {"serial": "28-1", "resolution": 11},
+        "http://probe2": {"serial": "28-2", "resolution": 11},
+        "http://probe3": {"serial": "28-3"},
+    }
+    configs = [{"profile": "http://profile", "heater": "http://heater1",
+                "probe": "http://probe1", "name": "Fermenter1"},
+               {"profile": None, "heater": "http://heater2",
+                "probe": "http://probe2", "name": "Fermenter2"},
+               {"profile": "http://profile", "heater": "http://heater3",
+                "probe": "http://probe3", "name": "Fermenter3"}]
+    fermenters = _load_fermenters(api, *configs)
+    assert_equal(fermenters["28-1"].probe_resolution, 11)
+    assert_equal(fermenters["28-2"].probe_resolution, 9)
+    # Active without a configured resolution, e.g. it was idle before
+    assert_equal(fermenters["28-3"].probe_resolution, 12)
+
+
+def test__load_fermenters_one_request_per_type():
+    resources = {
+        "fermentationprofiles": {1: {"setpoint": 18.0, "hysterisis": 0.3}},
+        "heaters": {}, "tempprobes": {},
+    }
+    configs = []
+    for i in range(1, 6):
+        resources["heaters"][i] = {"gpio_pin": 20 + i}
+        resources["tempprobes"][i] = {"serial": "28-%d" % i}
+        configs.append({"name": "Fermenter%d" % i,
+                        "profile": "/api/v1/fermentationprofiles/1/",
+                        "heater": "/api/v1/heaters/%d/" % i,
+                        "probe": "/api/v1/tempprobes/%d/" % i})
+    server = FakeTastyPie(resources)
+    try:
+        api = connect_to_rest_service(server.url)
+        del server.requests[:]
+        fermenters = _load_fermenters(api, *configs)
+        assert_equal(sorted(path for path, _ in server.requests), [
+            "/api/v1/fermentationprofiles/set/1/",
+            "/api/v1/heaters/set/1;2;3;4;5/",
+            "/api/v1/tempprobes/set/1;2;3;4;5/"])
+        assert_equal(fermenters["28-3"].gpio_pin, 23)
+        assert_equal(fermenters["28-5"].setpoint, 18.0)
+    finally:
+        server.close()
 
 
 @mock.patch("tempcontrol.config._setup_gpio")
-@mock.patch("tempcontrol.config.get_fermenter")
+@mock.patch("tempcontrol.config.get_fermenters")
 @mock.patch("tempcontrol.config._load_cooler")
 @mock.patch("tempcontrol.config._load_fermenters")
-def test_load_config(_load_fermenters, _load_cooler, get_fermenter,
+def test_load_config(_load_fermenters, _load_cooler, get_fermenters,
                      _setup_gpio):
     api = mock.Mock()
     response = mock.Mock()
@@ -282,14 +939,723 @@ def test_load_config(_load_fermenters, _load_cooler, get_fermenter,
         }]
     }
     api.tempcontrolservers.get.return_value = response
-    fermenters, fridge = load_config(api, "testserver")
-    get_fermenter.assert_called_with(api, "http://fermenter1")
-    _load_fermenters.assert_called_with(api, get_fermenter())
+    get_fermenters.return_value = {"http://fermenter1": {"name": "one"}}
+    _load_fermenters.return_value = {"28-1": Fermenter("one", 20.0, 22)}
+    _load_cooler.return_value = Fridge(24)
+    fermenters, fridges = load_config(api, "testserver")
+    get_fermenters.assert_called_with(api, ["http://fermenter1"])
+    _load_fermenters.assert_called_with(api, {"name": "one"})
     _load_cooler.assert_called_with(api)
-    pins = [f.gpio_pin for f in fermenters.values()]
-    _setup_gpio.assert_called_with(fridge.gpio_pin, *pins)
-    assert_equal(fermenters, _load_fermenters())
-    assert_equal(fridge, _load_cooler())
+    _setup_gpio.assert_called_with(24, 22)
+    assert_equal(fermenters, _load_fermenters.return_value)
+    assert_equal(fermenters["28-1"].cooler_pin, 24)
+    assert_equal(fridges.keys(), [24])
+
+
+def test_fetch_config_coolers():
+    server = _config_server()
+    try:
+        server.resources["coolers"][2] = {"gpio_pin": 26}
+        server.resources["tempprobes"][2] = {"serial": "28-2"}
+        server.resources["fermenters"][2] = dict(
+            server.resources["fermenters"][1], name="two",
+            probe="/api/v1/tempprobes/2/", cooler="/api/v1/coolers/2/")
+        server.resources["tempcontrolservers"][1]["fermenters"].append(
+            "/api/v1/fermenters/2/")
+        api = connect_to_rest_service(server.url)
+        del server.requests[:]
+        fermenters, fridges = fetch_config(api, "pi")
+        assert_equal(sorted(fridges), [24, 26])
+        assert_equal(fermenters["28-1"].cooler_pin, 24)
+        assert_equal(fermenters["28-2"].cooler_pin, 26)
+        assert_in(("/api/v1/coolers/set/2/", httplib.OK), server.requests)
+    finally:
+        server.close()
+
+
+@mock.patch("tempcontrol.config._setup_gpio")
+@mock.patch("tempcontrol.config._gpio_output")
+def test_reconcile_keeps_running_objects(output, _setup_gpio):
+    fermenters, fridges = reconcile({}, None, {
+        "28-1": Fermenter("one", 20.0, 22, cooler_pin=24),
+        "28-2": Fermenter("two", 18.0, 23, cooler_pin=24),
+    }, {24: Fridge(24)})
+    _setup_gpio.assert_called_once_with(22, 23, 24)
+    one = fermenters["28-1"]
+    fridge = fridges[24]
+    one.temp = 25.0
+    assert_equal(one.state, Fermenter.COOLING)
+    with mock.patch("tempcontrol._gpio_output"):
+        fridge.turn_on()
+    _setup_gpio.reset_mock()
+
+    live_fermenters, live_fridges = fermenters, fridges
+    fermenters, fridges = reconcile(fermenters, fridges, {
+        "28-1": Fermenter("one", 19.0, 22, hysterisis=0.3, cooler_pin=24),
+        "28-3": Fermenter("three", None, 25, cooler_pin=24),
+    }, {24: Fridge(24)})
+    assert fermenters is live_fermenters
+    assert fridges is live_fridges
+    assert fridges[24] is fridge
+    assert_equal(fridge.state, Fridge.WAITING)
+    assert fermenters["28-1"] is one
+    assert_equal((one.setpoint, one.hysterisis), (19.0, 0.3))
+    assert_equal(one.state, Fermenter.COOLING)
+    assert_equal(sorted(fermenters.keys()), ["28-1", "28-3"])
+    output.assert_called_once_with(23, 0)
+    _setup_gpio.assert_called_once_with(25)
+
+
+@mock.patch("tempcontrol.config._setup_gpio")
+@mock.patch("tempcontrol.config._gpio_output")
+def test_reconcile_pin_remap(output, _setup_gpio):
+    fermenters, fridges = reconcile({}, None,
+                                    {"28-1": Fermenter("one", 20.0, 22,
+                                                       cooler_pin=24)},
+                                    {24: Fridge(24)})
+    _setup_gpio.reset_mock()
+    old_fridge, new_fridge = fridges[24], Fridge(26)
+    with mock.patch("tempcontrol._gpio_output") as fridge_output:
+        old_fridge.turn_on()
+        fermenters, fridges = reconcile(fermenters, fridges,
+                                        {"28-1": Fermenter("one", 20.0, 27,
+                                                           cooler_pin=26)},
+                                        {26: new_fridge})
+    fridge_output.assert_called_once_with(24, 0)
+    assert_equal(old_fridge.state, Fridge.OFF)
+    assert_equal(fermenters["28-1"].gpio_pin, 27)
+    assert_equal(fermenters["28-1"].cooler_pin, 26)
+    assert_equal(fridges, {26: new_fridge})
+    output.assert_called_once_with(22, 0)
+    _setup_gpio.assert_called_once_with(27, 26)
+
+
+class FakeTastyPie(object):
+    """
+    Local stand-in for the django config server's TastyPie API.
+
+    :param resources: {resource_name: {id: object}}
+    """
+    def __init__(self, resources):
+        self.resources = resources
+        self.requests = []
+        self.version = 0
+        self.changes = []
+        self.changed = threading.Condition()
+        self.closed = False
+        self.connections = set()
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                fake.connections.add(self.connection)
+
+            def finish(self):
+                fake.connections.discard(self.connection)
+                BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        self.server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        """ Server url, as given in the config file """
+        return "http://%s:%d/" % self.server.server_address
+
+    def uri(self, resource_name, pk):
+        return "/api/v1/%s/%s/" % (resource_name, pk)
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+        # Hang up on kept-alive connections, or their handler threads
+        # outlive the test waiting for another request
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def get(self, resource_name, pk):
+        return dict(self.resources[resource_name][pk],
+                    resource_uri=self.uri(resource_name, pk))
+
+    def change(self, *uris):
+        """ Report uris as changed to anyone long-polling for changes """
+        with self.changed:
+            self.version += 1
+            self.changes.append((self.version, uris))
+            self.changed.notify_all()
+
+    def wait_for_changes(self, params):
+        deadline = time.time() + float(params["timeout"])
+        since = int(params.get("since", self.version))
+        if "since" not in params:
+            deadline = 0
+        with self.changed:
+            while self.version <= since and time.time() < deadline and \
+                    not self.closed:
+                self.changed.wait(deadline - time.time())
+            return {"version": self.version,
+                    "changed": [uri for version, uris in self.changes
+                                if version > since for uri in uris]}
+
+    def handle(self, request):
+        url = urlparse.urlsplit(request.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = [part for part in url.path.split("/") if part][2:]
+        status, body = httplib.OK, None
+        if not parts:
+            body = dict((name, {"list_endpoint": "/api/v1/%s/" % name})
+                        for name in self.resources)
+        elif parts[0] not in self.resources:
+            status = httplib.NOT_FOUND
+        elif parts[1:] == ["changes"]:
+            body = self.wait_for_changes(params)
+        elif len(parts) == 1:
+            objects = [self.get(parts[0], pk)
+                       for pk in sorted(self.resources[parts[0]])]
+            objects = [obj for obj in objects
+                       if all(str(obj.get(k)) == v
+                              for k, v in params.items())]
+            body = {"meta": {"total_count": len(objects)},
+                    "objects": objects}
+        elif parts[1] == "set":
+            pks = [int(pk) for pk in parts[2].split(";")]
+            body = {"objects": [self.get(parts[0], pk) for pk in pks
+                                if pk in self.resources[parts[0]]],
+                    "not_found": [str(pk) for pk in pks
+                                  if pk not in self.resources[parts[0]]]}
+        elif int(parts[1]) in self.resources[parts[0]]:
+            body = self.get(parts[0], int(parts[1]))
+        else:
+            status = httplib.NOT_FOUND
+        body = json.dumps(body)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if status == httplib.OK and \
+                request.headers.get("If-None-Match") == etag:
+            status, body = httplib.NOT_MODIFIED, ""
+        self.requests.append((url.path, status))
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.send_header("ETag", etag)
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def test_CachingAPI():
+    server = FakeTastyPie({"fermenters": {1: {"name": "one"}}})
+    try:
+        api = CachingAPI(connect_to_rest_service(server.url), ttl=3600)
+        uri = server.uri("fermenters", 1)
+        del server.requests[:]
+        assert_equal(get_fermenter(api, uri)["name"], "one")
+        assert_equal(get_fermenter(api, uri)["name"], "one")
+        assert_equal(server.requests, [(uri, httplib.OK)])
+
+        api.ttl = 0
+        assert_equal(get_fermenter(api, uri)["name"], "one")
+        assert_equal(server.requests[-1], (uri, httplib.NOT_MODIFIED))
+
+        server.resources["fermenters"][1]["name"] = "renamed"
+        assert_equal(get_fermenter(api, uri)["name"], "renamed")
+        assert_equal(server.requests[-1], (uri, httplib.OK))
+        assert_equal((api.hits, api.revalidated, api.misses), (1, 1, 2))
+    finally:
+        server.close()
+
+
+def test_connect_to_rest_service_reuses_connections():
+    server = FakeTastyPie({"fermenters": {1: {"name": "one"}}})
+    try:
+        api = connect_to_rest_service(server.url)
+        for _ in range(4):
+            get_fermenter(api, server.uri("fermenters", 1))
+        pool = api.request.pool
+        # 1 request to find the resources + 4 fetches on one connection
+        assert_equal((pool.requests, pool.reused), (5, 4))
+        assert pool.mean_latency > 0
+    finally:
+        server.close()
+
+
+def test_ConnectionPool_retries_closed_connection():
+    server = FakeTastyPie({"fermenters": {1: {"name": "one"}}})
+    try:
+        pool = ConnectionPool(maxsize=1, timeout=1)
+        url = server.url + "api/v1/fermenters/1/"
+        assert_equal(pool.request("GET", url)[0], httplib.OK)
+        for conns in pool._idle.values():
+            for conn in conns:
+                conn.sock.close()
+        assert_equal(pool.request("GET", url)[0], httplib.OK)
+        pool.close()
+    finally:
+        server.close()
+
+
+def test_CachingAPI_lru():
+    api = mock.Mock()
+    api.make_request.return_value.status = httplib.OK
+    cache = CachingAPI(api, maxsize=2)
+    for path in ("/a", "/b", "/a", "/c", "/a", "/b"):
+        cache.get(path)
+    requested = [c[0][1] for c in api.make_request.call_args_list]
+    assert_equal(requested, ["/a", "/b", "/c", "/b"])
+
+
+@mock.patch("time.time")
+def test_CachingAPI_revalidates_every_refresh(time_):
+    api = mock.Mock()
+    api.make_request.return_value.status = httplib.OK
+    cache = CachingAPI(api)
+    for now in (0, REFRESH_INTERVAL, 2 * REFRESH_INTERVAL):
+        time_.return_value = now
+        cache.get("/a")
+    assert_equal(api.make_request.call_count, 3)
+    assert_equal(cache.hits, 0)
+
+
+def test_get_tempcontrolserver_error():
+    api = mock.Mock()
+    api.tempcontrolservers.get.return_value.status = \
+        httplib.INTERNAL_SERVER_ERROR
+    try:
+        get_tempcontrolserver(api, "testserver")
+    except ConfigError:
+        pass
+    else:
+        assert False, "expected ConfigError"
+
+
+def test_snapshot_round_trip():
+    fermenters = {"28-1": Fermenter("one", 20.0, 22, hysterisis=0.3,
+                                    probe_resolution=11, cooler_pin=24)}
+    snapshot = make_snapshot(fermenters, {24: Fridge(24)})
+    new_fermenters, fridges = from_snapshot(snapshot)
+    assert_equal(fridges.keys(), [24])
+    fermenter = new_fermenters["28-1"]
+    assert_equal((fermenter.name, fermenter.setpoint, fermenter.gpio_pin,
+                  fermenter.hysterisis, fermenter.probe_resolution,
+                  fermenter.cooler_pin),
+                 ("one", 20.0, 22, 0.3, 11, 24))
+    assert_equal(make_snapshot(new_fermenters, fridges), snapshot)
+
+
+def test_ConfigRefresher_keeps_last_good_snapshot():
+    fetch = mock.Mock()
+    fetch.side_effect = [ConfigError, ConfigError,
+                         ({"28-1": Fermenter("one", 20.0, 22)}, {24: Fridge(24)}),
+                         ({"28-1": Fermenter("one", 20.0, 22)}, {24: Fridge(24)}),
+                         ConfigError]
+    refresher = ConfigRefresher(fetch, interval=30, min_backoff=5)
+    assert_false(refresher.refresh())
+    assert_equal((refresher.snapshot, refresher.delay), (None, 5))
+    assert_false(refresher.refresh())
+    assert_equal(refresher.delay, 10)
+    assert refresher.refresh()
+    assert_equal(refresher.delay, 30)
+    snapshot = refresher.snapshot
+    assert_equal(snapshot.fridge_pins, (24,))
+    assert refresher.refresh()
+    assert refresher.snapshot is snapshot, "unchanged config republished"
+    assert_false(refresher.refresh())
+    assert refresher.snapshot is snapshot
+
+
+def test_ConfigRefresher_background_thread():
+    refresher = ConfigRefresher(lambda: ({}, {24: Fridge(24)}),
+                                interval=0.01)
+    refresher.start()
+    try:
+        assert refresher.wait(1)
+    finally:
+        refresher.stop()
+    assert_equal(refresher.snapshot.fridge_pins, (24,))
+
+
+def test_ConfigRefresher_snapshot_file():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "config", "config.json")
+        fermenters = {"28-1": Fermenter("one", 20.0, 22)}
+        refresher = ConfigRefresher(lambda: (fermenters, {24: Fridge(24)}),
+                                    snapshot_file=filename)
+        assert_false(refresher.wait(0))
+        refresher.refresh()
+        assert_equal(load_snapshot(filename), refresher.snapshot)
+
+        # Restart with the server down
+        refresher = ConfigRefresher(mock.Mock(side_effect=ConfigError),
+                                    snapshot_file=filename)
+        assert refresher.wait(0)
+        assert_equal(refresher.snapshot,
+                     make_snapshot(fermenters, {24: Fridge(24)}))
+        # Saved before there could be more than one fridge
+        with open(filename, "w") as f:
+            json.dump({"fridge_pin": 24, "fermenters": [{
+                "serial": "28-1", "name": "one", "setpoint": 20.0,
+                "gpio_pin": 22, "hysterisis": 0.5,
+                "probe_resolution": None}]}, f)
+        snapshot = load_snapshot(filename)
+        assert_equal(snapshot.fridge_pins, (24,))
+        assert_equal(snapshot.fermenters[0].cooler_pin, 24)
+        with open(filename, "w") as f:
+            f.write("{corrupt")
+        assert_equal(load_snapshot(filename), None)
+    finally:
+        shutil.rmtree(directory)
+
+
+def _config_server():
+    """ FakeTastyPie with one fermenter on server "pi" """
+    return FakeTastyPie({
+        "tempcontrolservers": {1: {"name": "pi", "fermenters": [
+            "/api/v1/fermenters/1/"]}},
+        "fermenters": {1: {"name": "one", "heater": "/api/v1/heaters/1/",
+                           "probe": "/api/v1/tempprobes/1/",
+                           "profile": "/api/v1/fermentationprofiles/1/"}},
+        "heaters": {1: {"gpio_pin": 22}},
+        "tempprobes": {1: {"serial": "28-1"}},
+        "fermentationprofiles": {1: {"setpoint": 20.0, "hysterisis": 0.5}},
+        "coolers": {1: {"gpio_pin": 24}},
+    })
+
+
+def test_ChangeFeed_refetches_only_changed_resources():
+    server = _config_server()
+    try:
+        api = CachingAPI(connect_to_rest_service(server.url), ttl=3600)
+        feed = ChangeFeed(server.url, "pi", on_change=api.invalidate,
+                          timeout=0.1)
+        fetch_config(api, "pi")
+        assert_equal(feed.wait(), [])
+        assert_equal(feed.wait(), [], "nothing changed before the timeout")
+
+        uri = server.uri("fermentationprofiles", 1)
+        server.resources["fermentationprofiles"][1]["setpoint"] = 18.0
+        server.change(uri)
+        assert_equal(feed.wait(), [uri])
+        del server.requests[:]
+        fermenters, _ = fetch_config(api, "pi")
+        assert_equal(fermenters["28-1"].setpoint, 18.0)
+        assert_equal(server.requests,
+                     [("/api/v1/fermentationprofiles/set/1/", httplib.OK)])
+        feed.close()
+    finally:
+        server.close()
+
+
+def test_ChangeFeed_unsupported():
+    server = FakeTastyPie({"fermenters": {}})
+    try:
+        feed = ChangeFeed(server.url, "pi")
+        assert_equal(feed.wait(), None)
+        assert_false(feed.supported)
+        assert_equal(feed.wait(), None)
+        assert_equal(len(server.requests), 1)
+        feed.close()
+    finally:
+        server.close()
+
+
+def test_ConfigRefresher_change_feed():
+    server = _config_server()
+    try:
+        api = CachingAPI(connect_to_rest_service(server.url), ttl=3600)
+        feed = ChangeFeed(server.url, "pi", on_change=api.invalidate,
+                          timeout=0.2)
+        refresher = ConfigRefresher(lambda: fetch_config(api, "pi"),
+                                    interval=3600, changes=feed)
+        refresher.start()
+        try:
+            assert refresher.wait_for_update(1)
+            while feed.version is None:
+                time.sleep(0.01)
+            server.resources["fermentationprofiles"][1]["setpoint"] = 18.0
+            server.change(server.uri("fermentationprofiles", 1))
+            assert refresher.wait_for_update(1), "change not picked up"
+            assert_equal(refresher.snapshot.fermenters[0].setpoint, 18.0)
+        finally:
+            refresher.stop()
+            feed.close()
+    finally:
+        server.close()
+
+
+def test_ConfigRefresher_change_during_first_fetch():
+    server = _config_server()
+    try:
+        api = CachingAPI(connect_to_rest_service(server.url), ttl=3600)
+        feed = ChangeFeed(server.url, "pi", on_change=api.invalidate,
+                          timeout=0.2)
+        fetches = []
+        def load():
+            config = fetch_config(api, "pi")
+            if not fetches:
+                server.resources["fermentationprofiles"][1]["setpoint"] = 18.0
+                server.change(server.uri("fermentationprofiles", 1))
+            fetches.append(config)
+            return config
+        refresher = ConfigRefresher(load, interval=3600, changes=feed)
+        refresher.start()
+        try:
+            deadline = time.time() + 2
+            while len(fetches) < 2 and time.time() < deadline:
+                refresher.wait_for_update(0.1)
+            assert_equal(len(fetches), 2, "change not picked up")
+            assert_equal(refresher.snapshot.fermenters[0].setpoint, 18.0)
+        finally:
+            refresher.stop()
+            feed.close()
+    finally:
+        server.close()
+
+
+def test_Runtime_tasks_are_independent():
+    runtime = Runtime()
+    hung = threading.Event()
+    runtime.add("slow", hung.wait, 0)
+    broken = runtime.add("broken", mock.Mock(side_effect=IOError), 0.01)
+    fast = runtime.add("fast", mock.Mock(), 0.01)
+    runtime.start()
+    try:
+        assert_false(runtime.wait(0.1))
+    finally:
+        hung.set()
+        runtime.stop()
+    assert fast.func.call_count > 2, "fast task held up"
+    assert broken.failures > 2, "broken task gave up"
+    assert_equal(fast.failures, 0)
+    assert runtime.wait(0)
+
+
+def test_Task_wake():
+    task = Task("test", mock.Mock(), 3600)
+    task.start()
+    try:
+        while not task.runs:
+            time.sleep(0.01)
+        task.wake()
+        for _ in range(100):
+            if task.func.call_count == 2:
+                break
+            time.sleep(0.01)
+    finally:
+        task.stop()
+    assert_equal(task.func.call_count, 2)
+
+
+@mock.patch("tempcontrol.cmd.graphite_sender")
+@mock.patch("tempcontrol.cmd.Runtime")
+@mock.patch("tempcontrol.cmd.ConfigRefresher")
+def test_main_loop_interruptible_waiting_for_config(ConfigRefresher, Runtime,
+                                                    graphite_sender):
+    refresher = ConfigRefresher.return_value
+    refresher.wait.side_effect = [False, False, KeyboardInterrupt]
+    try:
+        main_loop(mock.Mock(), sampler=mock.Mock(), snapshot_file=None)
+    except KeyboardInterrupt:
+        pass
+    else:
+        assert False, "expected KeyboardInterrupt"
+    assert_equal(refresher.wait.mock_calls, [mock.call(1)] * 3)
+    refresher.stop.assert_called_once_with(timeout=1)
+    assert_false(Runtime.return_value.start.called)
+
+
+@mock.patch("tempcontrol.LOG_TO_GRAPHITE", False)
+@mock.patch("tempcontrol._gpio_outputs", OutputManager(FakeBackend()))
+def test_Controller():
+    clock = mock.Mock(return_value=0)
+    pins = gpio_outputs().backend.values
+    fermenters = {"28-1": Fermenter("one", 20.0, 22, cooler_pin=24)}
+    refresher = mock.Mock(snapshot=make_snapshot(fermenters,
+                                                 {24: Fridge(24)}))
+    sampler = mock.Mock()
+    sampler.serials.return_value = ["28-1"]
+    sampler.latest.return_value = (1, 25.0)
+    controller = Controller(refresher, sampler, clock=clock)
+    controller.tick()
+    assert_equal(controller.fermenters["28-1"].temp, 25.0)
+    assert_equal(controller.fridges[24].state, Fridge.WAITING)
+    assert_equal(pins, {22: 0, 24: 0})
+
+    # The compressor delay runs out between readings
+    clock.return_value = Fridge.WAIT_TIME
+    sampler.latest.return_value = (2, 25.0)
+    controller.tick()
+    assert_equal(controller.fridges[24].state, Fridge.WAITING)
+    controller.scheduler.run_pending()
+    assert_equal(controller.fridges[24].state, Fridge.ON)
+    assert_equal(pins, {22: 0, 24: 1})
+
+    controller.teardown()
+    assert_equal(pins, {22: 0, 24: 0})
+
+
+@mock.patch("tempcontrol._gpio_outputs", OutputManager(FakeBackend()))
+@mock.patch("tempcontrol.LOG_TO_GRAPHITE", False)
+def test_Controller_silent_probe():
+    clock = mock.Mock(return_value=0)
+    pins = gpio_outputs().backend.values
+    fermenters = {"28-1": Fermenter("one", 20.0, 22)}
+    refresher = mock.Mock(snapshot=make_snapshot(fermenters, {}))
+    sampler = mock.Mock()
+    sampler.serials.return_value = ["28-1"]
+    sampler.latest.return_value = (1, 15.0)
+    controller = Controller(refresher, sampler, clock=clock)
+    controller.tick()
+    fermenter = controller.fermenters["28-1"]
+    assert_equal(fermenter.state, Fermenter.HEATING)
+    assert_equal(pins[22], 1)
+
+    # The probe stops reporting, the old reading is kept for a while...
+    clock.return_value = READING_TIMEOUT
+    controller.tick()
+    assert_equal(pins[22], 1)
+    # ...then dropped, and stays dropped across a config refresh
+    clock.return_value = READING_TIMEOUT + 1
+    controller.tick()
+    assert_equal(fermenter.temp, None)
+    assert_equal(fermenter.state, Fermenter.IDLE)
+    assert_equal(pins[22], 0)
+    refresher.snapshot = make_snapshot(fermenters, {})
+    for _ in range(100):
+        clock.return_value += 1
+        controller.tick()
+    assert_equal(controller.fermenters["28-1"].state, Fermenter.IDLE)
+    assert_equal(pins[22], 0)
+
+    # It comes back
+    sampler.latest.return_value = (2, 15.0)
+    controller.tick()
+    assert_equal(pins[22], 1)
+
+
+def test_monotonic():
+    t = monotonic()
+    with mock.patch("time.time", return_value=0):
+        assert monotonic() >= t
+
+
+def test_Scheduler():
+    clock = mock.Mock(return_value=0)
+    scheduler = Scheduler(clock=clock)
+    calls = []
+    scheduler.call_at(2, calls.append, 2)
+    scheduler.call_later(1, calls.append, 1)
+    scheduler.cancel(scheduler.call_at(1.5, calls.append, 1.5))
+    assert_equal(scheduler.next_deadline(), 1)
+    assert_equal(scheduler.run_pending(), 0)
+    clock.return_value = 2
+    assert_equal(scheduler.run_pending(), 2)
+    assert_equal(calls, [1, 2])
+    assert_equal(scheduler.next_deadline(), None)
+
+
+def test_Scheduler_thread():
+    scheduler = Scheduler()
+    fired = threading.Event()
+    scheduler.start()
+    try:
+        scheduler.call_later(3600, fired.set)
+        start = scheduler.now()
+        scheduler.call_later(0.05, fired.set)
+        assert fired.wait(1)
+        assert scheduler.now() - start >= 0.05
+    finally:
+        scheduler.stop()
+
+
+@mock.patch("tempcontrol._gpio_output")
+def test_Fridge_scheduler(output):
+    clock = mock.Mock(return_value=0)
+    scheduler = Scheduler(clock=clock)
+    fridges = [Fridge(24, scheduler, min_on_time=300, min_off_time=120),
+               Fridge(25, scheduler, wait_time=30, min_cycle_time=600)]
+    for fridge in fridges:
+        fridge.turn_on()
+    clock.return_value = 30
+    scheduler.run_pending()
+    assert_equal([f.state for f in fridges], [Fridge.WAITING, Fridge.ON])
+    output.assert_called_with(25, 1)
+    clock.return_value = Fridge.WAIT_TIME
+    scheduler.run_pending()
+    assert_equal(fridges[0].state, Fridge.ON)
+    output.assert_called_with(24, 1)
+
+    # Held on for min_on_time, then kept off for min_off_time
+    for fridge in fridges:
+        fridge.turn_off()
+    assert_equal([f.state for f in fridges], [Fridge.ON, Fridge.OFF])
+    clock.return_value = Fridge.WAIT_TIME + 300
+    scheduler.run_pending()
+    assert_equal(fridges[0].state, Fridge.OFF)
+    fridges[0].turn_on()
+    assert_equal(fridges[0].deadline, Fridge.WAIT_TIME + 300 + 120)
+
+    # 25 came on at 30 so can't come on again before 630
+    fridges[1].turn_on()
+    assert_equal(fridges[1].deadline, 630)
+    fridges[1].turn_off()
+    clock.return_value = 630
+    scheduler.run_pending()
+    assert_equal(fridges[1].state, Fridge.OFF, "cancelled timer fired")
+
+
+def test_ThermalModel():
+    model = ThermalModel(10.0, ambient=20.0, loss=1e-3, heater_rate=0.01,
+                         fridge_temp=0.0)
+    assert_almost_equal(model.step(1000), 20.0 - 10.0 / math.e)
+    model.temp = 20.0
+    assert_almost_equal(model.step(10, heating=True), 20.1)
+    assert model.step(100, cooling=True) < 20.1
+
+
+def test_Simulation():
+    fermenters = {"28-1": Fermenter("ale", 18.0, 22, hysterisis=0.3,
+                                    cooler_pin=24),
+                  "28-2": Fermenter("lager", 10.0, 23, hysterisis=0.3,
+                                    cooler_pin=25)}
+    models = {"28-1": ThermalModel(15.0, activity=2e-5),
+              "28-2": ThermalModel(12.0)}
+    simulation = Simulation(fermenters, models, [24, 25],
+                            fridge_settings={"WAIT_TIME": 120,
+                                             "MIN_OFF_TIME": 600})
+    try:
+        report = simulation.run(12 * 3600)
+        assert_equal(report.ticks, 12 * 360)
+        assert report.heater_cycles["28-1"] > 0
+        assert report.compressor_cycles[25] > 0
+        assert 0 < report.duty[25] < 1
+        for serial, fermenter in fermenters.items():
+            assert abs(models[serial].temp - fermenter.setpoint) < 1, serial
+            assert report.overshoot[serial] < 0.5, serial
+            assert report.undershoot[serial] > -0.5, serial
+        # Starts are MIN_OFF_TIME + WAIT_TIME apart at least
+        assert report.compressor_cycles[25] <= 12 * 3600 / 720 + 1
+        assert report.cpu_per_tick > 0
+        assert tempcontrol._gpio_outputs is not simulation.outputs
+    finally:
+        simulation.close()
+    assert_false(os.path.exists(simulation.base_dir))
 
 
 class AlmostAlwaysTrue(object):